@@ -1,139 +1,343 @@
+import argparse
 import logging
 from os import environ
+import re
+from time import sleep, time
 from typing import List
 
-from bs4 import BeautifulSoup
-
+from app import ArchiveInterface
+from app import compress
+from app import logs
+from app import metrics
 from app import parse
+from app import pipeline
 from app import SqliteInterface
 from app import WebInterface
 
 
+REVIEW_PAGE_PATH = r"/game/([^/]+)/([^/]+)/(user|critic)-reviews\?page=(\d+)$"
+PLATFORM_HOME_PATH = r"/game/([^/?]+)$"
+# Crawl phases in order, with the frontier kinds each one crawls; a
+# completed phase is checkpointed in app_state and skipped on restart
+PHASES = [
+    ("genre_urls", None),
+    ("last_page", ["last_page"]),
+    ("titles", ["titles"]),
+    ("reviews", ["user", "critic"]),
+]
+
+
 
 class App:
 
-    def __init__(self, data_path="."):
+    def __init__(self, data_path=".", workers=4, parse_workers=2, archive_path=None,
+                 base_url=parse.BASE_URL, throttle_seconds=10, metrics_path=None,
+                 metrics_seconds=30, profile_rate=0, stream=False):
+        self.base_url = base_url
         self.log = self.get_logger("MCGameScraper")
         self.db = SqliteInterface.Interface(data_path=data_path)
         self.log.debug("Database connection extablished.")
-        self.web = WebInterface.Interface(self.get_logger("WebInterface"))
+        released = self.db.release_all_frontier()
+        if released:
+            self.log.info("Released %s pages leased before a restart.", released)
+        self.log.info("Dedup index bytes: %s", self.db.index.memory())
+        self.archive = ArchiveInterface.Interface(archive_path or f"{data_path}/archive")
+        self.web = WebInterface.Interface(self.get_logger("WebInterface"),
+                                          throttle_seconds=throttle_seconds,
+                                          max_workers=workers,
+                                          state_path=f"{data_path}/MCScraper.throttle.json",
+                                          archive=self.archive)
         self.log.debug("Web interface connection extablished.")
+        self.batch_size = workers * 2
+        self.refresh_mode = False
+        # Streaming scrapes each page on the writer as it downloads
+        self.pipeline = pipeline.Pipeline(self.get_logger("Pipeline"),
+                                          self.web.fetch_chunks if stream else self.web.fetch,
+                                          parse.scrape_page, fetch_workers=workers,
+                                          parse_workers=parse_workers,
+                                          capacity=self.batch_size * 2,
+                                          profile_rate=profile_rate,
+                                          profile_path=f"{data_path}/profiles",
+                                          stream=parse.PageStream if stream else None)
+        self.metrics = metrics.Flusher(metrics.REGISTRY, metrics_path or f"{data_path}/metrics",
+                                       interval=metrics_seconds).start()
 
     def get_logger(self, name):
-        logger = logging.getLogger(name)
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter("%(asctime)s [%(name)-14s] %(levelname)-8s %(message)s")
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        logger.setLevel(logging.DEBUG)
-        return logger
+        return logs.get_logger(name)
 
     def main(self):
-        self.populate_title_by_genre_urls_to_crawl()
-        self.log.debug("All title-by-genre listing page URLs present in database.")
-        run = True
-        while run:
-            final_page_crawl = self.db.get_one_incomplete_last_page_crawl()
-            if not final_page_crawl:
-                run = False
+        for phase, kinds in PHASES:
+            if self.db.get_state(f"phase:{phase}"):
+                self.log.info("Phase %s already complete; skipping.", phase)
+                continue
+            if kinds is None:
+                self.populate_title_by_genre_urls_to_crawl()
             else:
-                self.populate_titles_by_genre_final_page_number(final_page_crawl)
-        self.log.debug("All title-by-genre listing page final page numbers recorded.")
-        run = True
-        while run:
-            title_crawl = self.db.get_one_incomplete_title_crawl()
-            if not title_crawl:
-                run = False
-            else:
-                self.populate_games(*title_crawl)
-        run = True
-        while run:
-            game_crawl = self.db.get_one_incomplete_game_crawl()
-            if not game_crawl:
+                self.crawl(kinds)
+            if self.phase_complete(kinds):
+                self.db.set_state(f"phase:{phase}", time())
+                self.log.debug("Phase %s complete.", phase)
+        self.close()
+        return True
+
+    def phase_complete(self, kinds: List[str]) -> bool:
+        """True if nothing is left to do for a phase's frontier kinds."""
+        if kinds is None:
+            return not self.db.get_platforms_without_genre_crawl_urls()
+        stats = self.db.frontier_stats()
+        return not any(stats.get(_k, {}).get(SqliteInterface.FRONTIER_PENDING)
+                       or stats.get(_k, {}).get(SqliteInterface.FRONTIER_CLAIMED)
+                       for _k in kinds)
+
+    def close(self):
+        self.web.close()
+        self.metrics.stop()
+
+    def refresh(self) -> bool:
+        """Re-crawl listing and review pages from the first page, stopping
+        each pagination at the first page with nothing new."""
+        self.refresh_mode = True
+        # Until the refresh finishes, main() must not skip its requeued pages
+        self.db.clear_state("phase:titles", "phase:reviews")
+        self.db.refresh_frontier()
+        self.log.info("Refreshing title-by-genre listing pages.")
+        self.crawl(["titles"])
+        self.log.info("Refreshing review pages.")
+        self.crawl(["user", "critic"])
+        for phase, kinds in PHASES[2:]:
+            if self.phase_complete(kinds):
+                self.db.set_state(f"phase:{phase}", time())
+        self.close()
+        return True
+
+    def crawl(self, kinds: List[str]) -> bool:
+        """Fetch, parse and write frontier pages of the given kinds until
+        none remain, waiting out the backoff of failed pages to retry."""
+        while True:
+            self.pipeline.run(claim=lambda count: self.db.claim_frontier(kinds, count),
+                              url=self.crawl_url,
+                              parse_args=lambda crawl, html: (crawl[0], html, crawl[-1]),
+                              write=self.write_page)
+            retry_at = self.db.next_frontier_retry(kinds)
+            if retry_at is None:
+                break
+            self.log.info("Retrying failed pages in %.0fs.", max(retry_at - time(), 0))
+            sleep(max(retry_at - time(), 0))
+        self.log.info("HTTP stats: %s", self.web.stats())
+        self.log.info("Frontier: %s", self.db.frontier_stats())
+        self.log.info("Dedup index bytes: %s", self.db.index.memory())
+        return True
+
+    def scrape(self, crawl: List, html) -> bool:
+        """Parse and store a page claimed from the frontier, in this process."""
+        scraped = None if html is None else parse.scrape_page(crawl[0], html, crawl[-1])
+        return self.write_page(crawl, html, scraped)
+
+    def write_page(self, crawl: List, html, scraped, gone: bool = None) -> bool:
+        """Store a scraped frontier page, or fail it if scraped is None: for
+        good if gone, by default if its fetch answered 404 or 410, and
+        otherwise to be retried.
+
+        scraped is scrape_page's dict, or a parse.PageStream whose items are
+        written as they are parsed from the download.
+        """
+        kind, page = crawl[0], crawl[-1]
+        if scraped is None:
+            url = self.crawl_url(crawl)
+            if gone is None:
+                gone = self.web.gone(url)
+            self.log.warning("No page returned for %s%s.", url, "; gone" if gone else "")
+            self.db.fail_frontier(*self.frontier_key(crawl), permanent=gone)
+            metrics.count(f"pages_failed_{kind}")
+            return False
+        if isinstance(scraped, parse.PageStream):
+            final_page_number, items = scraped.final, scraped
+        else:
+            final_page_number, items = scraped["final_page_number"], scraped["items"]
+            for step, seconds in scraped.get("timings", {}).items():
+                metrics.observe(f"parse_{step}", seconds)
+        try:
+            if kind == "last_page":
+                if callable(final_page_number):
+                    final_page_number = final_page_number()
+                self.db.add_final_platform_genre_page_number(crawl[1], final_page_number)
+                self.log.debug("%s has %s pages.", crawl[1], final_page_number)
+                metrics.count(f"pages_{kind}")
                 return True
-            crawl_type = game_crawl.pop()
-            if crawl_type == "user":
-                self.scrape_user_reviews(*game_crawl)
-            elif crawl_type == "critic":
-                self.scrape_critic_reviews(*game_crawl)
+            if kind == "titles":
+                ref = self.db.platform_genre_crawl_url_exists(crawl[1])
+                platform_pk = self.db.get_platform_pk_from_genre_crawl_url(crawl[1])
+                genre_pk = self.db.get_genre_pk_from_genre_crawl_url(crawl[1])
+                added = self.db.write_games_page(crawl[1], page, items, platform_pk, genre_pk)
+            elif kind == "user":
+                ref = crawl[1]
+                added = self.db.write_user_review_page(ref, page, items, final_page_number,
+                                                       push_pages=not self.refresh_mode)
+            elif kind == "critic":
+                ref = crawl[1]
+                added = self.db.write_critic_review_page(ref, page, items, final_page_number,
+                                                         push_pages=not self.refresh_mode)
+            else:
+                raise RuntimeError
+        except OSError as e:
+            # Only a stream still reads from the network here; its rows were rolled back
+            self.log.warning("%s while reading %s.", type(e).__name__, self.crawl_url(crawl))
+            self.db.fail_frontier(*self.frontier_key(crawl))
+            metrics.count(f"pages_failed_{kind}")
+            return False
+        found = items.count if isinstance(items, parse.PageStream) else len(items)
+        self.log.debug("All %s scraped from page; %s of %s new.",
+                       "games" if kind == "titles" else "reviews", added, found)
+        metrics.count(f"pages_{kind}")
+        metrics.count(f"rows_{kind}", added)
+        metrics.count(f"rows_{kind}_seen", found)
+        if self.refresh_mode:
+            self.paginate_refresh(kind, ref, page, found, added)
+        return True
+
+    def paginate_refresh(self, kind: str, ref, page: int, found: int, added: int) -> bool:
+        """Queue the next page unless this one was already entirely known."""
+        if found and not added:
+            self.log.debug("Page %s of %s %s already known; stopping.", page, kind, ref)
+            return False
+        final_page_number = self.db.get_final_page_number(kind, ref)
+        if final_page_number is None or page >= final_page_number:
+            return False
+        self.db.requeue_frontier(kind, ref, page + 1)
+        return True
+
+    def replay(self, since: float = 0) -> bool:
+        """Rebuild the database from archived pages, without the network."""
+        self.log.info("Replaying %s archived fetches.", self.archive.count())
+        for url, fetched_at, html in self.archive.replay(since):
+            if not self.route(url, html):
+                self.log.warning("No handler for archived page %s.", url)
+        self.log.info("Replay complete.")
+        self.metrics.stop()
+        return True
+
+    def rebuild_search_index(self) -> bool:
+        self.log.info("Rebuilding full-text review indexes.")
+        self.db.rebuild_search_index()
+        self.log.info("Rebuild complete.")
+        self.close()
+        return True
+
+    def compress_bodies(self) -> bool:
+        self.log.info("Compressing review bodies.")
+        self.log.info("Bodies compressed: %s", self.db.compress_bodies())
+        self.db.vacuum()
+        self.log.info("Compression complete.")
+        self.close()
+        return True
+
+    def review_aggregates(self, rebuild=False) -> bool:
+        """Verify the per-game review aggregates, recomputing them first if rebuild."""
+        if rebuild:
+            self.log.info("Rebuilding review aggregates.")
+            self.db.rebuild_review_aggregates()
+        mismatched = self.db.verify_review_aggregates()
+        if mismatched:
+            self.log.warning("%s review aggregates differ from the reviews, e.g. %s.",
+                             len(mismatched), mismatched[:5])
+        else:
+            self.log.info("Review aggregates verified.")
+        self.close()
+        return not mismatched
+
+    def route(self, url, html) -> bool:
+        """Dispatch a fetched page to the method that scrapes it."""
+        match = re.match(re.escape(self.base_url) + PLATFORM_HOME_PATH, url)
+        if match:
+            return self.populate_genre_crawl_urls(match.group(1), html)
+        match = re.match(re.escape(self.base_url) + REVIEW_PAGE_PATH, url)
+        if match:
+            platform_slug, game_slug, review_type, page = match.groups()
+            platform_pk = self.db.platform_exists(platform_slug)
+            game_pk = self.db.game_exists(game_slug, platform_pk)
+            if not game_pk:
+                return False
+            scrape = self.scrape_user_reviews if review_type == "user" \
+                else self.scrape_critic_reviews
+            return scrape(game_pk, game_slug, platform_pk, platform_slug, int(page), html=html)
+        listing_url, _, page = url.partition("?page=")
+        if self.db.platform_genre_crawl_url_exists(listing_url):
+            if page:
+                return self.populate_games(listing_url, int(page), html=html)
+            return self.populate_titles_by_genre_final_page_number(listing_url, html=html)
+        return False
 
     # Main function methods
     def populate_title_by_genre_urls_to_crawl(self) -> bool:
         self.log.info("Parsing title-by-genre listing page URLs.")
-        for slug in self.db.get_platforms_without_genre_crawl_urls():
-            platform_home_url = f"https://www.metacritic.com/game/{slug}"
-            html = self.web.fetch(platform_home_url)
-            soup = BeautifulSoup(html, features="html5lib")
-            for url in parse.get_title_by_genre_listing_page_urls(soup):
-                if not self.db.platform_genre_crawl_url_exists(url):
-                    platform_pk = self.db.platform_exists(slug)
-                    genre_pk = self.db.genre_exists(url.split("/")[-2])
-                    self.db.new_platform_genre_crawl_url(platform_pk, genre_pk, url)
-                    self.log.debug("New titles-by-genre listing page URL recorded.")
-            self.log.debug(f"Completed scraping titles-by-genre listing pages for {slug}.")
-            self.db.update_genre_crawl_complete(slug)
+        home_urls = {f"{self.base_url}/game/{slug}": slug
+                     for slug in self.db.get_platforms_without_genre_crawl_urls()}
+        for platform_home_url, html in self.web.fetch_many(home_urls):
+            if html is None:
+                self.log.warning("No page returned for %s.", platform_home_url)
+                continue
+            self.populate_genre_crawl_urls(home_urls[platform_home_url], html)
         return True
 
-    def populate_titles_by_genre_final_page_number(self, url) -> bool:
-        self.log.info("Parsing title-by-genre listing final page number.")
-        html = self.web.fetch(url)
-        soup = BeautifulSoup(html, features="html5lib")
-        final_page = int(parse.get_last_page_number(soup))
-        self.db.add_final_platform_genre_page_number(url, final_page)
-        self.log.debug(f"{url} has {final_page} pages.")
+    def populate_genre_crawl_urls(self, slug, html) -> bool:
+        soup = parse.make_soup(html, "genre_nav")
+        platform_pk = self.db.platform_exists(slug)
+        for url in parse.get_title_by_genre_listing_page_urls(soup, self.base_url):
+            genre_pk = self.db.genre_exists(url.split("/")[-2])
+            if self.db.new_platform_genre_crawl_url(platform_pk, genre_pk, url):
+                self.log.debug("New titles-by-genre listing page URL recorded.")
+        self.log.debug("Completed scraping titles-by-genre listing pages for %s.", slug)
+        self.db.update_genre_crawl_complete(slug)
         return True
 
-    def populate_games(self, url, page) -> bool:
+    def populate_titles_by_genre_final_page_number(self, url, html=None) -> bool:
+        self.log.info("Parsing title-by-genre listing final page number.")
+        if html is None:
+            html = self.web.fetch(url)
+        return self.scrape(["last_page", url, 0], html)
+
+    def populate_games(self, url, page, html=None) -> bool:
         self.log.info("Scraping games from title-by-genre listing page.")
-        platform_pk = self.db.get_platform_pk_from_genre_crawl_url(url)
-        genre_pk = self.db.get_genre_pk_from_genre_crawl_url(url)
-        url_pg = f"{url}?page={page}"
-        html = self.web.fetch(url_pg)
-        soup = BeautifulSoup(html, features="html5lib")
-        for game in parse.scrape_games(soup):
-            game["platform"] = platform_pk
-            game_pk = self.db.new_game(**game)
-            self.log.debug(f"{game['title']} added to games.")
-            self.db.new_game_genre_association(game_pk, genre_pk)
-        self.db.update_last_platform_genre_page_scraped(url, page)
-        self.log.debug("All games scraped from page.")
-        return True
+        if html is None:
+            html = self.web.fetch(f"{url}?page={page}")
+        return self.scrape(["titles", url, page], html)
 
-    def scrape_user_reviews(self, game_pk, game_slug, platform_pk, platform_slug, page_number) -> bool:
+    def scrape_user_reviews(self, game_pk, game_slug, platform_pk, platform_slug, page_number,
+                            html=None) -> bool:
             url = self.review_page_url("user", game_slug, platform_slug, page_number)
-            self.log.info(f"Scraping reviews from {url}.")
-            html = self.web.fetch(url)
-            soup = BeautifulSoup(html, features="html5lib")
-            if page_number == 0:  # final page number is Null
-                final_page_number = parse.get_last_page_number(soup) 
-                self.db.add_final_review_page_number(game_pk, "user", final_page_number)
-            for review in parse.scrape_user_reviews(soup):
-                review["game_pk"] = game_pk
-                self.db.new_user_review(**review)
-                self.log.debug("New user review added to user_reviews.")
-            self.db.update_last_review_page_scraped(game_pk, "user", page_number)
-            self.log.debug("All reviews scraped from page.")
-            return True
-
-    def scrape_critic_reviews(self, game_pk, game_slug, platform_pk, platform_slug, page_number) -> bool:
+            self.log.info("Scraping reviews from %s.", url)
+            if html is None:
+                html = self.web.fetch(url)
+            return self.scrape(["user", game_pk, game_slug, platform_pk, platform_slug,
+                                page_number], html)
+
+    def scrape_critic_reviews(self, game_pk, game_slug, platform_pk, platform_slug, page_number,
+                              html=None) -> bool:
             url = self.review_page_url("critic", game_slug, platform_slug, page_number)
-            self.log.info(f"Scraping reviews from {url}.")
-            html = self.web.fetch(url)
-            soup = BeautifulSoup(html, features="html5lib")
-            if page_number == 0:  # final page number is Null
-                final_page_number = parse.get_last_page_number(soup) 
-                self.db.add_final_review_page_number(game_pk, "critic", final_page_number)
-            for review in parse.scrape_critic_reviews(soup):
-                review["game_pk"] = game_pk
-                self.db.new_critic_review(**review)
-                self.log.debug("New critic review added to critic_reviews.")
-            self.db.update_last_review_page_scraped(game_pk, "critic", page_number)
-            self.log.debug("All reviews scraped from page.")
-            return True
+            self.log.info("Scraping reviews from %s.", url)
+            if html is None:
+                html = self.web.fetch(url)
+            return self.scrape(["critic", game_pk, game_slug, platform_pk, platform_slug,
+                                page_number], html)
     
+    def frontier_key(self, crawl: List) -> tuple:
+        """Return the (kind, ref, page) frontier row a claimed crawl came from."""
+        kind = crawl[0]
+        ref = crawl[1] if kind in ["user", "critic"] \
+            else self.db.platform_genre_crawl_url_exists(crawl[1])
+        return kind, ref, crawl[-1]
+
     # URL constructors
+    def crawl_url(self, crawl: List) -> str:
+        kind = crawl[0]
+        if kind == "last_page":
+            return crawl[1]
+        if kind == "titles":
+            return f"{crawl[1]}?page={crawl[2]}"
+        return self.review_page_url(kind, crawl[2], crawl[4], crawl[5])
+
     def game_page_url(self, game_slug, platform_slug):
-        return f"https://www.metacritic.com/game/{platform_slug}/{game_slug}"
+        return f"{self.base_url}/game/{platform_slug}/{game_slug}"
 
     def review_page_url(self, review_type, game_slug, platform_slug, page=0):
         if review_type not in ["critic", "user"]:
@@ -142,5 +346,78 @@ class App:
 
 
 if __name__ == "__main__":
-    app = App()
-    app.main()
+    parser = argparse.ArgumentParser(description="Metacritic game review scraper")
+    parser.add_argument("--data-path", default=".")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--parse-workers", type=int, default=2)
+    parser.add_argument("--archive-path", default=None,
+                        help="raw HTML archive (default: DATA_PATH/archive)")
+    parser.add_argument("--replay", action="store_true",
+                        help="rebuild the database from the archive, offline")
+    parser.add_argument("--refresh", action="store_true",
+                        help="fetch only new games and reviews since the last crawl")
+    parser.add_argument("--metrics-path", default=None,
+                        help="where metrics.json and metrics.prom are written "
+                             "(default: DATA_PATH/metrics)")
+    parser.add_argument("--metrics-seconds", type=float, default=30,
+                        help="how often the metrics snapshot is rewritten")
+    parser.add_argument("--profile-rate", type=float, default=0,
+                        help="fraction of pages parsed and written under cProfile, "
+                             "dumped to DATA_PATH/profiles")
+    parser.add_argument("--rebuild-search", action="store_true",
+                        help="rebuild the full-text indexes over review bodies")
+    parser.add_argument("--compress-bodies", action="store_true",
+                        help="train zstd dictionaries, compress stored review bodies "
+                             "and store new ones compressed from then on (needs zstandard)")
+    parser.add_argument("--aggregates", choices=["verify", "rebuild"], default=None,
+                        help="check the per-game review aggregates against the review "
+                             "tables, or recompute them")
+    parser.add_argument("--stream", action="store_true",
+                        help="scrape pages as they download and write rows as they are "
+                             "parsed, instead of parsing whole pages in worker processes")
+    parser.add_argument("--log-level", default=environ.get("MCSCRAPER_LOG_LEVEL", "DEBUG"),
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    parser.add_argument("--log-sample", type=float, default=1,
+                        help="fraction of each DEBUG message kept, e.g. 0.01")
+    parser.add_argument("--serve", metavar="[HOST:]PORT", default=None,
+                        help="own the database and lease pages to --connect workers; "
+                             "binds to 127.0.0.1 unless HOST is given")
+    parser.add_argument("--connect", metavar="HOST:PORT", default=None,
+                        help="fetch and parse pages leased from a --serve coordinator")
+    args = parser.parse_args()
+    logs.configure(level=getattr(logging, args.log_level), sample=args.log_sample)
+    make_app = lambda: App(data_path=args.data_path, workers=args.workers,
+                           parse_workers=args.parse_workers, archive_path=args.archive_path,
+                           metrics_path=args.metrics_path,
+                           metrics_seconds=args.metrics_seconds,
+                           profile_rate=args.profile_rate, stream=args.stream)
+    if args.serve or args.connect:
+        # Managers unpickle every request, so the key is all that stands
+        # between the port and running code on the coordinator
+        authkey = environ.get("MCSCRAPER_AUTHKEY", "").encode()
+        if not authkey:
+            parser.error("--serve and --connect need a shared secret in MCSCRAPER_AUTHKEY")
+        from app import distributed  # multiprocessing.managers is slow to import
+    if args.serve:
+        host, _, port = args.serve.rpartition(":")
+        host = host or "127.0.0.1"
+        distributed.Coordinator(make_app).serve((host, int(port)), authkey)
+    elif args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        distributed.Worker((host, int(port)), authkey, data_path=args.data_path,
+                           workers=args.workers, parse_workers=args.parse_workers,
+                           archive_path=args.archive_path).run()
+    elif args.replay:
+        make_app().replay()
+    elif args.refresh:
+        make_app().refresh()
+    elif args.rebuild_search:
+        make_app().rebuild_search_index()
+    elif args.compress_bodies:
+        if not compress.AVAILABLE:
+            parser.error("--compress-bodies needs zstandard, which is not installed")
+        make_app().compress_bodies()
+    elif args.aggregates:
+        make_app().review_aggregates(rebuild=args.aggregates == "rebuild")
+    else:
+        make_app().main()
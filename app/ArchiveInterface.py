@@ -0,0 +1,144 @@
+import gzip
+from hashlib import sha256
+import os
+import sqlite3
+import threading
+from time import time
+from typing import Iterator, Tuple
+
+
+SCHEMAS = [
+    "CREATE TABLE IF NOT EXISTS 'fetches' ("
+    "  url TEXT NOT NULL,"
+    "  fetched_at REAL NOT NULL,"
+    "  digest TEXT NOT NULL"
+    ");"
+    ,
+    "CREATE INDEX IF NOT EXISTS fetches_fetched_at ON fetches (fetched_at);"
+    ,
+    "CREATE INDEX IF NOT EXISTS fetches_url ON fetches (url, fetched_at);"
+]
+# Applied in order to new and existing archives; PRAGMA user_version
+# records how many have run.
+MIGRATIONS = [
+    # 1 - HTTP validators for conditional re-fetches
+    [
+        "ALTER TABLE fetches ADD COLUMN etag TEXT DEFAULT NULL;",
+        "ALTER TABLE fetches ADD COLUMN last_modified TEXT DEFAULT NULL;",
+    ],
+]
+
+
+class Interface:
+    """Content-addressed, gzip-compressed store of fetched HTML.
+
+    Bodies live under objects/ named by their SHA-256, so a page fetched
+    many times unchanged is stored once; the fetches table records every
+    (url, fetched_at, digest) so the crawl can be replayed in order.
+    """
+
+    def __init__(self, archive_path: str):
+        self.path = archive_path
+        os.makedirs(f"{archive_path}/objects", exist_ok=True)
+        self.conn = sqlite3.connect(f"{archive_path}/index.sqlite3.db",
+                                    check_same_thread=False)
+        self.c = self.conn.cursor()
+        self.lock = threading.Lock()
+        for statement in SCHEMAS:
+            self.c.execute(statement)
+        self.conn.commit()
+        self.migrate()
+
+    def migrate(self):
+        version = self.c.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                self.c.execute(statement)
+            self.c.execute(f"PRAGMA user_version={number}")
+            self.conn.commit()
+
+    def object_path(self, digest: str) -> str:
+        return f"{self.path}/objects/{digest[:2]}/{digest}.gz"
+
+    def save(self, url: str, html: str, fetched_at: float = None,
+             etag: str = None, last_modified: str = None) -> str:
+        """Store html if new and record the fetch; return its digest."""
+        writer = self.open(url, fetched_at, etag, last_modified)
+        writer.write(html.encode())
+        return writer.close()
+
+    def open(self, url: str, fetched_at: float = None, etag: str = None,
+             last_modified: str = None) -> "Writer":
+        """Return a Writer that stores a body as it is downloaded."""
+        return Writer(self, url, fetched_at or time(), etag, last_modified)
+
+    def record(self, url: str, fetched_at: float, digest: str, etag: str = None,
+               last_modified: str = None) -> None:
+        with self.lock:
+            self.c.execute("INSERT INTO fetches (url, fetched_at, digest, etag, last_modified) "
+                           "VALUES (?,?,?,?,?)",
+                           (url, fetched_at, digest, etag, last_modified))
+            self.conn.commit()
+
+    def load(self, digest: str) -> str:
+        with open(self.object_path(digest), "rb") as f:
+            return gzip.decompress(f.read()).decode()
+
+    def latest(self, url: str):
+        """Return (digest, etag, last_modified) of the newest fetch of url, or None."""
+        with self.lock:
+            self.c.execute("SELECT digest, etag, last_modified FROM fetches "
+                           "WHERE url=? ORDER BY fetched_at DESC LIMIT 1", (url,))
+            return self.c.fetchone()
+
+    def replay(self, since: float = 0) -> Iterator[Tuple[str, float, str]]:
+        """Yield (url, fetched_at, html) for every archived fetch, oldest first."""
+        with self.lock:
+            self.c.execute("SELECT url, fetched_at, digest FROM fetches "
+                           "WHERE fetched_at >= ? ORDER BY fetched_at", (since,))
+            fetches = self.c.fetchall()
+        for url, fetched_at, digest in fetches:
+            yield url, fetched_at, self.load(digest)
+
+    def count(self) -> int:
+        with self.lock:
+            return self.c.execute("SELECT COUNT(*) FROM fetches").fetchone()[0]
+
+
+class Writer:
+    """Compresses and hashes a body chunk by chunk into a temporary file,
+    which close() moves to its content address and records."""
+
+    def __init__(self, archive: Interface, url: str, fetched_at: float, etag: str,
+                 last_modified: str):
+        self.archive = archive
+        self.fetch = (url, fetched_at)
+        self.validators = (etag, last_modified)
+        self.hash = sha256()
+        self.tmp = f"{archive.path}/objects/{threading.get_ident()}.{id(self)}.tmp"
+        self.file = open(self.tmp, "wb")
+        self.gzip = gzip.GzipFile(filename="", mode="wb", fileobj=self.file)
+
+    def write(self, data: bytes) -> None:
+        self.hash.update(data)
+        self.gzip.write(data)
+
+    def close(self) -> str:
+        """Store the body if new and record the fetch; return its digest."""
+        self.gzip.close()
+        self.file.close()
+        digest = self.hash.hexdigest()
+        path = self.archive.object_path(digest)
+        if os.path.isfile(path):
+            os.remove(self.tmp)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp, path)
+        self.archive.record(*self.fetch, digest, *self.validators)
+        return digest
+
+    def abort(self) -> None:
+        """Discard a body that was not completely downloaded."""
+        self.gzip.close()
+        self.file.close()
+        os.remove(self.tmp)
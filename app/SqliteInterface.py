@@ -1,7 +1,15 @@
+from datetime import datetime
+from functools import lru_cache
+from math import log1p
 import os
-from random import choice
+from random import sample
 import sqlite3
-from typing import List
+from time import time
+from typing import Callable, Iterable, List
+
+from app import compress
+from app import dedup
+from app import metrics
 
 
 PLATFORMS = [
@@ -93,16 +101,359 @@ SCHEMAS = [
     "  FOREIGN KEY (platform) REFERENCES platforms (rowid)"
     ");"
 ] 
+# Per-game review aggregates - the columns of review_aggregates, and what
+# one review of each type adds to them as SQL on the row alias {r}; grades
+# are bucketed 0-10 (critic grades by tens)
+AGGREGATE_COLUMNS = (["reviews", "graded", "grade_sum"] + [f"h{_b}" for _b in range(11)]
+                     + ["votes_total", "votes_helpful"])
+AGGREGATE_SOURCES = {
+    "user": {"table": "user_reviews", "bucket": "{r}.grade",
+             "votes_total": "{r}.votes_total", "votes_helpful": "{r}.votes_helpful"},
+    "critic": {"table": "critic_reviews", "bucket": "{r}.grade / 10",
+               "votes_total": "0", "votes_helpful": "0"},
+}
+
+
+def aggregate_row(row: tuple) -> dict:
+    """A (game, *AGGREGATE_COLUMNS) row as a dict, with the mean grade,
+    grade histogram and helpful-vote ratio."""
+    aggregate = dict(zip(["game"] + AGGREGATE_COLUMNS, row))
+    aggregate["mean_grade"] = aggregate["grade_sum"] / aggregate["graded"] \
+        if aggregate["graded"] else None
+    aggregate["histogram"] = [aggregate.pop(f"h{_b}") for _b in range(11)]
+    aggregate["helpful_ratio"] = aggregate["votes_helpful"] / aggregate["votes_total"] \
+        if aggregate["votes_total"] else None
+    return aggregate
+
+
+def _aggregate_terms(review_type: str, r: str) -> List[str]:
+    source = AGGREGATE_SOURCES[review_type]
+    bucket = source["bucket"].format(r=r)
+    return (["1", f"{r}.grade IS NOT NULL", f"COALESCE({r}.grade, 0)"]
+            + [f"({bucket}) IS {_b}" for _b in range(11)]
+            + [source["votes_total"].format(r=r), source["votes_helpful"].format(r=r)])
+
+
+def _aggregate_upsert(review_type: str, r: str, sign: str) -> str:
+    """Add (sign "+") or remove ("-") review row r's share of its game's aggregates."""
+    return (f"INSERT INTO review_aggregates (game, review_type, {', '.join(AGGREGATE_COLUMNS)})"
+            f" VALUES ({r}.game, '{review_type}', "
+            f"{', '.join(f'{sign}({_t})' for _t in _aggregate_terms(review_type, r))})"
+            f" ON CONFLICT (game, review_type) DO UPDATE SET "
+            f"{', '.join(f'{_c}={_c}+excluded.{_c}' for _c in AGGREGATE_COLUMNS)};")
+
+
+def _aggregate_select(review_type: str) -> str:
+    """Aggregates of review_type recomputed from its table, one row per game."""
+    return (f"SELECT r.game, '{review_type}', "
+            f"{', '.join(f'SUM({_t})' for _t in _aggregate_terms(review_type, 'r'))} "
+            f"FROM {AGGREGATE_SOURCES[review_type]['table']} r GROUP BY r.game")
+
+
+def _aggregate_triggers(review_type: str) -> List[str]:
+    table = AGGREGATE_SOURCES[review_type]["table"]
+    columns = "game, grade, votes_total, votes_helpful" if review_type == "user" \
+        else "game, grade"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_aggregate_insert AFTER INSERT ON {table} BEGIN "
+        f"{_aggregate_upsert(review_type, 'new', '+')} END;",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_aggregate_delete AFTER DELETE ON {table} BEGIN "
+        f"{_aggregate_upsert(review_type, 'old', '-')} END;",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_aggregate_update AFTER UPDATE OF {columns} "
+        f"ON {table} BEGIN {_aggregate_upsert(review_type, 'old', '-')} "
+        f"{_aggregate_upsert(review_type, 'new', '+')} END;",
+    ]
+
+
+def _search_index(table: str, compressed: bool) -> List[str]:
+    """(Re)create table's full-text index. A compressed table's index reads
+    bodies through body_text(), which only Interface connections register,
+    so it is installed only once the table has a dictionary."""
+    body = "body_text({}.body)" if compressed else "{}.body"
+    new, old = body.format("new"), body.format("old")
+    statements = [
+        f"DROP TRIGGER IF EXISTS {table}_fts_insert;",
+        f"DROP TRIGGER IF EXISTS {table}_fts_delete;",
+        f"DROP TRIGGER IF EXISTS {table}_fts_update;",
+        f"DROP TABLE IF EXISTS {table}_fts;",
+        f"DROP VIEW IF EXISTS {table}_text;",
+    ]
+    if compressed:
+        statements.append(f"CREATE VIEW {table}_text AS"
+                          f"  SELECT rowid, body_text(body) AS body FROM {table};")
+    content = f"{table}_text" if compressed else table
+    return statements + [
+        f"CREATE VIRTUAL TABLE {table}_fts USING fts5("
+        f"  body, content='{content}', content_rowid='rowid', tokenize='porter unicode61'"
+        f");",
+        f"CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN"
+        f"  INSERT INTO {table}_fts (rowid, body) VALUES (new.rowid, {new});"
+        f" END;",
+        f"CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN"
+        f"  INSERT INTO {table}_fts ({table}_fts, rowid, body) VALUES ('delete', old.rowid, {old});"
+        f" END;",
+        # Compressing a body in place leaves its text, and the index, unchanged
+        f"CREATE TRIGGER {table}_fts_update AFTER UPDATE OF body ON {table}"
+        f" WHEN {old} IS NOT {new} BEGIN"
+        f"  INSERT INTO {table}_fts ({table}_fts, rowid, body) VALUES ('delete', old.rowid, {old});"
+        f"  INSERT INTO {table}_fts (rowid, body) VALUES (new.rowid, {new});"
+        f" END;",
+        f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild');",
+    ]
+
+
+# Applied in order to new and existing databases; PRAGMA user_version
+# records how many have run.
+MIGRATIONS = [
+    # 1 - UNIQUE indexes on natural keys, dropping any duplicates first
+    [
+        "DELETE FROM platforms WHERE rowid NOT IN "
+        "  (SELECT MIN(rowid) FROM platforms GROUP BY slug);",
+        "DELETE FROM genres WHERE rowid NOT IN "
+        "  (SELECT MIN(rowid) FROM genres GROUP BY slug);",
+        "DELETE FROM games WHERE rowid NOT IN "
+        "  (SELECT MIN(rowid) FROM games GROUP BY slug, platform);",
+        "DELETE FROM games_to_genres WHERE game=0 OR rowid NOT IN "
+        "  (SELECT MIN(rowid) FROM games_to_genres GROUP BY game, genre);",
+        "DELETE FROM user_reviews WHERE rowid NOT IN "
+        "  (SELECT MIN(rowid) FROM user_reviews GROUP BY review_id);",
+        "DELETE FROM critic_reviews WHERE date IS NOT NULL AND rowid NOT IN "
+        "  (SELECT MIN(rowid) FROM critic_reviews GROUP BY author, date);",
+        "DELETE FROM platform_genre_crawls WHERE rowid NOT IN "
+        "  (SELECT MIN(rowid) FROM platform_genre_crawls GROUP BY url);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS platforms_slug ON platforms (slug);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS genres_slug ON genres (slug);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS games_slug_platform ON games (slug, platform);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS games_to_genres_game_genre "
+        "  ON games_to_genres (game, genre);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS user_reviews_review_id ON user_reviews (review_id);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS critic_reviews_author_date "
+        "  ON critic_reviews (author, date);",
+        "CREATE UNIQUE INDEX IF NOT EXISTS platform_genre_crawls_url "
+        "  ON platform_genre_crawls (url);",
+    ],
+    # 2 - crawl frontier: one row per pending page, seeded from progress columns
+    [
+        "CREATE TABLE IF NOT EXISTS 'frontier' ("
+        "  kind TEXT NOT NULL,"                 # last_page, titles, user, critic
+        "  ref INTEGER NOT NULL,"               # platform_genre_crawls or games rowid
+        "  page INTEGER NOT NULL,"
+        "  state INTEGER NOT NULL DEFAULT 0,"   # see FRONTIER_* below
+        "  lease_expires REAL DEFAULT NULL"
+        ");",
+        "CREATE UNIQUE INDEX IF NOT EXISTS frontier_kind_ref_page ON frontier (kind, ref, page);",
+        "CREATE INDEX IF NOT EXISTS frontier_state_kind ON frontier (state, kind);",
+        "CREATE INDEX IF NOT EXISTS frontier_state_lease ON frontier (state, lease_expires);",
+        "CREATE TABLE IF NOT EXISTS 'frontier_counts' ("
+        "  kind TEXT NOT NULL,"
+        "  state INTEGER NOT NULL,"
+        "  n INTEGER NOT NULL,"
+        "  PRIMARY KEY (kind, state)"
+        ");",
+        "CREATE TRIGGER IF NOT EXISTS frontier_count_insert AFTER INSERT ON frontier BEGIN"
+        "  INSERT INTO frontier_counts (kind, state, n) VALUES (new.kind, new.state, 1)"
+        "    ON CONFLICT (kind, state) DO UPDATE SET n=n+1;"
+        " END;",
+        "CREATE TRIGGER IF NOT EXISTS frontier_count_update AFTER UPDATE OF state ON frontier"
+        " WHEN old.state != new.state BEGIN"
+        "  UPDATE frontier_counts SET n=n-1 WHERE kind=old.kind AND state=old.state;"
+        "  INSERT INTO frontier_counts (kind, state, n) VALUES (new.kind, new.state, 1)"
+        "    ON CONFLICT (kind, state) DO UPDATE SET n=n+1;"
+        " END;",
+        "CREATE TRIGGER IF NOT EXISTS frontier_count_delete AFTER DELETE ON frontier BEGIN"
+        "  UPDATE frontier_counts SET n=n-1 WHERE kind=old.kind AND state=old.state;"
+        " END;",
+        "INSERT OR IGNORE INTO frontier (kind, ref, page) "
+        "  SELECT 'last_page', rowid, 0 FROM platform_genre_crawls "
+        "  WHERE final_page_number IS NULL;",
+        "INSERT OR IGNORE INTO frontier (kind, ref, page) "
+        "  WITH RECURSIVE pages(n) AS ("
+        "    SELECT 0 UNION ALL SELECT n+1 FROM pages "
+        "    WHERE n < (SELECT MAX(final_page_number) FROM platform_genre_crawls))"
+        "  SELECT 'titles', c.rowid, n FROM platform_genre_crawls c JOIN pages "
+        "  ON n BETWEEN COALESCE(c.last_page_scraped + 1, 0) AND c.final_page_number;",
+        "INSERT OR IGNORE INTO frontier (kind, ref, page) "
+        "  WITH RECURSIVE pages(n) AS ("
+        "    SELECT 0 UNION ALL SELECT n+1 FROM pages "
+        "    WHERE n < (SELECT MAX(final_user_review_page_number) FROM games))"
+        "  SELECT 'user', g.rowid, n FROM games g JOIN pages "
+        "  ON n BETWEEN COALESCE(g.last_user_review_page_scraped + 1, 0) "
+        "  AND COALESCE(g.final_user_review_page_number, 0);",
+        "INSERT OR IGNORE INTO frontier (kind, ref, page) "
+        "  WITH RECURSIVE pages(n) AS ("
+        "    SELECT 0 UNION ALL SELECT n+1 FROM pages "
+        "    WHERE n < (SELECT MAX(final_critic_review_page_number) FROM games))"
+        "  SELECT 'critic', g.rowid, n FROM games g JOIN pages "
+        "  ON n BETWEEN COALESCE(g.last_critic_review_page_scraped + 1, 0) "
+        "  AND COALESCE(g.final_critic_review_page_number, 0);",
+    ],
+    # 3 - crawl priority, and when each page was last completed
+    [
+        "ALTER TABLE frontier ADD COLUMN priority REAL NOT NULL DEFAULT 0;",
+        "ALTER TABLE frontier ADD COLUMN done_at REAL DEFAULT NULL;",
+        "DROP INDEX IF EXISTS frontier_state_kind;",
+        "CREATE INDEX IF NOT EXISTS frontier_state_kind_priority "
+        "  ON frontier (state, kind, priority DESC);",
+        "UPDATE frontier SET priority=frontier_priority(kind, page,"
+        "  (SELECT released FROM games WHERE rowid=frontier.ref),"
+        "  (SELECT metascore FROM games WHERE rowid=frontier.ref),"
+        "  (SELECT CASE frontier.kind WHEN 'user' THEN final_user_review_page_number"
+        "   ELSE final_critic_review_page_number END FROM games WHERE rowid=frontier.ref), 0)"
+        "  WHERE state=0 AND kind IN ('user', 'critic');",
+        "UPDATE frontier SET priority=frontier_priority(kind, page, NULL, NULL, NULL, 0)"
+        "  WHERE state=0 AND kind NOT IN ('user', 'critic');",
+    ],
+    # 4 - run state, e.g. which crawl phases are complete
+    [
+        "CREATE TABLE IF NOT EXISTS 'app_state' ("
+        "  key TEXT PRIMARY KEY,"
+        "  value TEXT NOT NULL"
+        ");",
+    ],
+    # 5 - full-text indexes over review bodies, kept in step by triggers and
+    # filled from the rows already there
+    [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS user_reviews_fts USING fts5("
+        "  body, content='user_reviews', content_rowid='rowid', tokenize='porter unicode61'"
+        ");",
+        "CREATE TRIGGER IF NOT EXISTS user_reviews_fts_insert AFTER INSERT ON user_reviews BEGIN"
+        "  INSERT INTO user_reviews_fts (rowid, body) VALUES (new.rowid, new.body);"
+        " END;",
+        "CREATE TRIGGER IF NOT EXISTS user_reviews_fts_delete AFTER DELETE ON user_reviews BEGIN"
+        "  INSERT INTO user_reviews_fts (user_reviews_fts, rowid, body) VALUES ('delete', old.rowid, old.body);"
+        " END;",
+        "CREATE TRIGGER IF NOT EXISTS user_reviews_fts_update AFTER UPDATE OF body ON user_reviews BEGIN"
+        "  INSERT INTO user_reviews_fts (user_reviews_fts, rowid, body) VALUES ('delete', old.rowid, old.body);"
+        "  INSERT INTO user_reviews_fts (rowid, body) VALUES (new.rowid, new.body);"
+        " END;",
+        "INSERT INTO user_reviews_fts (user_reviews_fts) VALUES ('rebuild');",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS critic_reviews_fts USING fts5("
+        "  body, content='critic_reviews', content_rowid='rowid', tokenize='porter unicode61'"
+        ");",
+        "CREATE TRIGGER IF NOT EXISTS critic_reviews_fts_insert AFTER INSERT ON critic_reviews BEGIN"
+        "  INSERT INTO critic_reviews_fts (rowid, body) VALUES (new.rowid, new.body);"
+        " END;",
+        "CREATE TRIGGER IF NOT EXISTS critic_reviews_fts_delete AFTER DELETE ON critic_reviews BEGIN"
+        "  INSERT INTO critic_reviews_fts (critic_reviews_fts, rowid, body) VALUES ('delete', old.rowid, old.body);"
+        " END;",
+        "CREATE TRIGGER IF NOT EXISTS critic_reviews_fts_update AFTER UPDATE OF body ON critic_reviews BEGIN"
+        "  INSERT INTO critic_reviews_fts (critic_reviews_fts, rowid, body) VALUES ('delete', old.rowid, old.body);"
+        "  INSERT INTO critic_reviews_fts (rowid, body) VALUES (new.rowid, new.body);"
+        " END;",
+        "INSERT INTO critic_reviews_fts (critic_reviews_fts) VALUES ('rebuild');",
+    ],
+    # 6 - zstd dictionaries for compressed review bodies, which are BLOBs
+    # where plain bodies are TEXT; see Interface.compress_bodies
+    [
+        "CREATE TABLE IF NOT EXISTS 'body_dictionaries' ("
+        "  id INTEGER PRIMARY KEY,"             # zstd dictionary id
+        "  table_name TEXT NOT NULL,"
+        "  data BLOB NOT NULL,"
+        "  created_at REAL NOT NULL"
+        ");",
+    ],
+    # 7 - per-game review aggregates, kept current by triggers and filled
+    # from the reviews already stored
+    [
+        "CREATE TABLE IF NOT EXISTS 'review_aggregates' ("
+        "  game INTEGER NOT NULL,"
+        "  review_type TEXT NOT NULL,"          # user, critic
+        "  reviews INTEGER NOT NULL,"
+        "  graded INTEGER NOT NULL,"            # reviews with a grade
+        "  grade_sum INTEGER NOT NULL,"
+        + "".join(f"  h{_b} INTEGER NOT NULL," for _b in range(11)) +
+        "  votes_total INTEGER NOT NULL,"
+        "  votes_helpful INTEGER NOT NULL,"
+        "  PRIMARY KEY (game, review_type)"
+        ");",
+        *_aggregate_triggers("user"),
+        *_aggregate_triggers("critic"),
+        f"INSERT INTO review_aggregates (game, review_type, {', '.join(AGGREGATE_COLUMNS)}) "
+        f"{_aggregate_select('user')} UNION ALL {_aggregate_select('critic')};",
+    ],
+    # 8 - reviews by game, for keyset pages of one game's reviews
+    [
+        "CREATE INDEX IF NOT EXISTS user_reviews_game ON user_reviews (game);",
+        "CREATE INDEX IF NOT EXISTS critic_reviews_game ON critic_reviews (game);",
+    ],
+    # 9 - failed fetches are retried with backoff
+    [
+        "ALTER TABLE frontier ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;",
+        "ALTER TABLE frontier ADD COLUMN retry_after REAL DEFAULT NULL;",
+    ],
+]
+FRONTIER_PENDING = 0
+FRONTIER_CLAIMED = 1
+FRONTIER_DONE = 2
+FRONTIER_FAILED = 3     # gone for good, or out of attempts
+# A failed page is pending again after RETRY_SECONDS, doubling with each
+# attempt, until MAX_ATTEMPTS
+FRONTIER_RETRY_SECONDS = 60
+FRONTIER_MAX_ATTEMPTS = 5
+# Terms of frontier_priority; a page's score is their weighted sum
+PRIORITY_WEIGHTS = {
+    "recency": 2.0,     # 1 for a game released today, 1/2 a year on, ...
+    "metascore": 1.0,   # metascore / 100
+    "reviews": 0.5,     # log(1 + final review page number)
+    "depth": -0.1,      # per page into the pagination
+    "staleness": 0.05,  # per day since the page was last crawled, up to a year
+}
+
+
+@lru_cache(maxsize=65536)
+def _release_age_days(released: str):
+    try:
+        return (datetime.now() - datetime.strptime(released, "%B %d, %Y")).days
+    except (TypeError, ValueError):
+        return None
+
+
+def frontier_priority(kind: str, page: int, released: str = None, metascore: int = None,
+                      final_page_number: int = None, stale_days: float = 0) -> float:
+    """Score a pending page; higher scores are claimed sooner.
 
+    Review pages of recent, well-rated games with many pages of reviews
+    come first, earlier pages before later ones. Listing pages go in page
+    order, which is newest release first. Also registered as an SQL
+    function for set-based inserts.
+    """
+    w = PRIORITY_WEIGHTS
+    score = w["depth"] * page + w["staleness"] * min(stale_days or 0, 365)
+    if kind not in ["user", "critic"]:
+        return score
+    age_days = _release_age_days(released)
+    if age_days is not None:
+        score += w["recency"] / (1 + max(age_days, 0) / 365)
+    score += w["metascore"] * (metascore or 0) / 100
+    score += w["reviews"] * log1p(final_page_number or 0)
+    return score
 
 
+def _recording(items: Iterable, keys: list, key: Callable):
+    """Yield items, appending key(item) to keys as each one goes by."""
+    for item in items:
+        keys.append(key(item))
+        yield item
+
+
+@metrics.instrument("db")
 class Interface:
 
     def __init__(self, data_path: str):
         if not os.path.isfile(f"{data_path}/MCScraper.sqlite3.db"):
             self.make_database(data_path)
         self.conn = sqlite3.connect(f"{data_path}/MCScraper.sqlite3.db")
+        self.conn.create_function("frontier_priority", 6, frontier_priority,
+                                  deterministic=True)
+        # Dictionaries are loaded after migrating, which may create their table
+        self.codec = compress.BodyCodec()
+        self.conn.create_function("body_text", 1, self.codec.decode, deterministic=True)
         self.c = self.conn.cursor()
+        self.c.execute("PRAGMA journal_mode=WAL")
+        self.c.execute("PRAGMA synchronous=NORMAL")
+        self.migrate()
+        self.codec.load(self.c)
+        self.index = dedup.Index().load(self.c)
 
     # Utility, initial table population, etc.
     def make_database(self, data_path):
@@ -116,95 +467,227 @@ class Interface:
             self.c.execute("INSERT INTO genres (slug) VALUES (?)", (genre,))
         self.conn.commit()
 
+    def migrate(self):
+        """Bring an existing database up to date with MIGRATIONS."""
+        version = self.c.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            # sqlite3 would run DDL outside a transaction, so each migration
+            # opens its own and commits with its user_version, or not at all
+            with self.conn:
+                self.c.execute("BEGIN")
+                for statement in statements:
+                    self.c.execute(statement)
+                self.c.execute(f"PRAGMA user_version={number}")
+
     #def get_title_by_genre_crawls_without_final_page(self) -> List:
     #    self.c.execute("SELECT url FROM platform_genre_crawls WHERE final_page_number IS NULL")
     #    return [_i[0] for _i in self.c.fetchall()]
 
     def get_platform_slug(self, platform_pk) -> str:
-        self.c.execute("SELECT slug FROM platforms WHERE rowid=?", (platform_pk,))
-        return self.c.fetchone()[0]
+        return self.index.platform_slugs[platform_pk]
 
     def get_game_slug(self, game_pk) -> str:
         self.c.execute("SELECT slug FROM games WHERE rowid=?", (game_pk,))
         return self.c.fetchone()[0]
 
     def get_platform_pk_from_genre_crawl_url(self, url):
-        self.c.execute("SELECT platform FROM platform_genre_crawls WHERE url=?",
-                       (url,))
-        return self.c.fetchone()[0]
+        return self.index.crawls[url][1]
     
     def get_genre_pk_from_genre_crawl_url(self, url):
-        self.c.execute("SELECT genre FROM platform_genre_crawls WHERE url=?",
-                       (url,))
-        return self.c.fetchone()[0]
+        return self.index.crawls[url][2]
 
     def get_platforms_without_genre_crawl_urls(self):
         self.c.execute("SELECT slug FROM platforms WHERE genre_crawl_complete=0")
         return [_i[0] for _i in self.c.fetchall()]
 
-    def get_one_incomplete_last_page_crawl(self):
-        self.c.execute("SELECT url FROM platform_genre_crawls "
-                       "WHERE final_page_number IS NULL "
-                       "LIMIT 10")
-        result = self.c.fetchall()
-        if not result:
-            return False
-        return choice(result)[0]
-
-    def get_one_incomplete_title_crawl(self):
-        self.c.execute("SELECT * FROM platform_genre_crawls "
-                       "WHERE last_page_scraped IS NULL "
-                       "OR last_page_scraped < final_page_number "
-                       "LIMIT 10")
-        result = self.c.fetchall()
-        if not result:
-            return False
-        result = choice(result)
-        page = 0 if result[4] == None else result[4] + 1
-        return [result[2], page]
-
-    def get_one_incomplete_game_crawl(self):
-        self.c.execute("SELECT * FROM games "
-                       "WHERE final_user_review_page_number IS NULL "
-                       "OR final_critic_review_page_number IS NULL "
-                       "OR last_user_review_page_scraped < final_user_review_page_number "
-                       "OR last_critic_review_page_scraped < final_critic_review_page_number "
-                       "LIMIT 20")
-        result = self.c.fetchall()
-        if not result:
-            return False
-        result = choice(result)
-        if not result[6] or result[6] < result[5]:
-            page = 0 if result[6] == None else result[6] + 1
-            review_type = "user"
-        elif not result[8] or result[8] < result[7]:
-            page = 0 if result[8] == None else result[8] + 1
-            review_type = "critic"
-        platform_slug = self.get_platform_slug(result[2])
-        game_pk = self.game_exists(result[1], result[2])
-        crawl = [game_pk, result[1], result[2], platform_slug, page, review_type]
-        return crawl
-
-    # Existence checks - return rowid if exists else False
-    def platform_exists(self, slug: str):
-        self.c.execute("SELECT rowid FROM platforms WHERE slug=?", (slug,))
+    # Run state - checkpoints kept across restarts
+    def get_state(self, key: str):
+        self.c.execute("SELECT value FROM app_state WHERE key=?", (key,))
         result = self.c.fetchone()
-        return result[0] if result else False
+        return result[0] if result else None
 
-    def genre_exists(self, slug: str):
-        self.c.execute("SELECT rowid FROM genres WHERE slug=?", (slug,))
+    def set_state(self, key: str, value):
+        with self.conn:
+            self.c.execute("INSERT INTO app_state (key, value) VALUES (?,?) "
+                           "ON CONFLICT (key) DO UPDATE SET value=excluded.value",
+                           (key, str(value)))
+
+    def clear_state(self, *keys: str):
+        with self.conn:
+            self.c.executemany("DELETE FROM app_state WHERE key=?", [(_k,) for _k in keys])
+
+    # Crawl frontier - pending pages are claimed under a lease, and
+    # completed by the page writes below
+    def claim_frontier(self, kinds: List[str], count: int, lease_seconds: float = 600) -> List:
+        """Lease up to count pending pages, drawn at random from the 2*count
+        highest-priority pages of the given kinds.
+
+        Returns [kind, url, page] for listing pages and
+        [kind, game_pk, game_slug, platform_pk, platform_slug, page] for
+        review pages.
+        """
+        now = time()
+        with self.conn:
+            self.c.execute("UPDATE frontier SET state=?, lease_expires=NULL "
+                           "WHERE state=? AND lease_expires < ?",
+                           (FRONTIER_PENDING, FRONTIER_CLAIMED, now))
+            # The top of each kind, merged, holds the top of them all
+            candidates = []
+            for kind in kinds:
+                self.c.execute("SELECT rowid, priority FROM frontier WHERE state=? AND kind=? "
+                               "AND (retry_after IS NULL OR retry_after <= ?) "
+                               "ORDER BY priority DESC LIMIT ?",
+                               (FRONTIER_PENDING, kind, now, count * 2))
+                candidates += self.c.fetchall()
+            candidates.sort(key=lambda _c: _c[1], reverse=True)
+            result = [_c[0] for _c in candidates[:count * 2]]
+            claimed = sample(result, min(count, len(result)))
+            self.c.executemany("UPDATE frontier SET state=?, lease_expires=? WHERE rowid=?",
+                               [(FRONTIER_CLAIMED, now + lease_seconds, _i) for _i in claimed])
+        crawls = []
+        for rowid in claimed:
+            self.c.execute("SELECT f.kind, f.ref, f.page, c.url, g.slug, g.platform, p.slug "
+                           "FROM frontier f "
+                           "LEFT JOIN platform_genre_crawls c "
+                           "  ON f.kind IN ('last_page', 'titles') AND c.rowid=f.ref "
+                           "LEFT JOIN games g ON f.kind IN ('user', 'critic') AND g.rowid=f.ref "
+                           "LEFT JOIN platforms p ON p.rowid=g.platform "
+                           "WHERE f.rowid=?", (rowid,))
+            kind, ref, page, url, game_slug, platform_pk, platform_slug = self.c.fetchone()
+            if kind in ["last_page", "titles"]:
+                crawls.append([kind, url, page])
+            else:
+                crawls.append([kind, ref, game_slug, platform_pk, platform_slug, page])
+        return crawls
+
+    def fail_frontier(self, kind: str, ref, page: int, permanent: bool = False):
+        """Return a page that could not be fetched to pending, to be
+        claimed again after a backoff, or mark it failed if permanent or
+        out of attempts."""
+        with self.conn:
+            self.c.execute("UPDATE frontier SET lease_expires=NULL, attempts=attempts+1,"
+                           "  state=CASE WHEN ? OR attempts+1 >= ? THEN ? ELSE ? END,"
+                           "  retry_after=? + ? * (1 << attempts) "
+                           "WHERE kind=? AND ref=? AND page=?",
+                           (permanent, FRONTIER_MAX_ATTEMPTS, FRONTIER_FAILED,
+                            FRONTIER_PENDING, time(), FRONTIER_RETRY_SECONDS, kind, ref, page))
+
+    def next_frontier_retry(self, kinds: List[str]):
+        """When the next pending page of kinds may be claimed, or None if
+        none is pending."""
+        self.c.execute("SELECT MIN(COALESCE(retry_after, 0)) FROM frontier "
+                       f"WHERE state=? AND kind IN ({','.join('?' * len(kinds))})",
+                       (FRONTIER_PENDING, *kinds))
+        return self.c.fetchone()[0]
+
+    def release_frontier(self, kind: str, ref, page: int):
+        with self.conn:
+            self.c.execute("UPDATE frontier SET state=?, lease_expires=NULL "
+                           "WHERE kind=? AND ref=? AND page=? AND state=?",
+                           (FRONTIER_PENDING, kind, ref, page, FRONTIER_CLAIMED))
+
+    def release_all_frontier(self) -> int:
+        """Return every claimed page to pending; for the frontier's only
+        owner starting up, when any lease left is a dead process's."""
+        with self.conn:
+            self.c.execute("UPDATE frontier SET state=?, lease_expires=NULL WHERE state=?",
+                           (FRONTIER_PENDING, FRONTIER_CLAIMED))
+            return self.c.rowcount
+
+    def renew_frontier(self, keys: List, lease_seconds: float = 600):
+        """Extend the leases of claimed (kind, ref, page) rows."""
+        expires = time() + lease_seconds
+        with self.conn:
+            self.c.executemany("UPDATE frontier SET lease_expires=? "
+                               "WHERE kind=? AND ref=? AND page=? AND state=?",
+                               [(expires, _k, _r, _p, FRONTIER_CLAIMED) for _k, _r, _p in keys])
+
+    def requeue_frontier(self, kind: str, ref, page: int):
+        priority = self._frontier_priorities(kind, ref, [page])[0]
+        with self.conn:
+            self.c.execute("INSERT INTO frontier (kind, ref, page, priority) VALUES (?,?,?,?) "
+                           "ON CONFLICT (kind, ref, page) DO UPDATE "
+                           "SET state=?, lease_expires=NULL, priority=excluded.priority,"
+                           "  attempts=0, retry_after=NULL",
+                           (kind, ref, page, priority, FRONTIER_PENDING))
+
+    def refresh_frontier(self):
+        """Requeue the first listing and review pages for an incremental
+        re-crawl, those crawled longest ago first."""
+        now = time()
+        with self.conn:
+            self.c.execute("SELECT f.rowid, f.kind, f.page, f.done_at, g.released, g.metascore, "
+                           "  CASE f.kind WHEN 'user' THEN g.final_user_review_page_number "
+                           "  ELSE g.final_critic_review_page_number END "
+                           "FROM frontier f "
+                           "LEFT JOIN games g ON f.kind IN ('user', 'critic') AND g.rowid=f.ref "
+                           "WHERE f.kind IN ('titles', 'user', 'critic') AND f.page=0 "
+                           "AND f.state!=?", (FRONTIER_PENDING,))
+            self.c.executemany("UPDATE frontier SET state=?, lease_expires=NULL, priority=?,"
+                               "  attempts=0, retry_after=NULL WHERE rowid=?",
+                               [(FRONTIER_PENDING,
+                                 frontier_priority(kind, page, released, metascore, final,
+                                                   (now - (done_at or 0)) / 86400),
+                                 rowid)
+                                for rowid, kind, page, done_at, released, metascore, final
+                                in self.c.fetchall()])
+
+    def get_final_page_number(self, kind: str, ref):
+        if kind == "titles":
+            self.c.execute("SELECT final_page_number FROM platform_genre_crawls "
+                           "WHERE rowid=?", (ref,))
+        elif kind in ["critic", "user"]:
+            self.c.execute(f"SELECT final_{kind}_review_page_number FROM games "
+                           "WHERE rowid=?", (ref,))
+        else:
+            raise RuntimeError
         result = self.c.fetchone()
-        return result[0] if result else False
+        return result[0] if result else None
+
+    def frontier_stats(self) -> dict:
+        """Return {kind: {state: count}} from the trigger-maintained counters."""
+        self.c.execute("SELECT kind, state, n FROM frontier_counts")
+        stats = {}
+        for kind, state, n in self.c.fetchall():
+            stats.setdefault(kind, {})[state] = n
+        return stats
+
+    def _complete_frontier(self, kind: str, ref, page: int):
+        self.c.execute("UPDATE frontier SET state=?, lease_expires=NULL, done_at=?,"
+                       "  attempts=0, retry_after=NULL WHERE kind=? AND ref=? AND page=?",
+                       (FRONTIER_DONE, time(), kind, ref, page))
+
+    def _push_frontier_pages(self, kind: str, ref, first: int, last: int):
+        pages = range(first, last + 1)
+        self.c.executemany("INSERT INTO frontier (kind, ref, page, priority) VALUES (?,?,?,?) "
+                           "ON CONFLICT (kind, ref, page) DO NOTHING",
+                           [(kind, ref, _p, _s) for _p, _s
+                            in zip(pages, self._frontier_priorities(kind, ref, pages))])
+
+    def _frontier_priorities(self, kind: str, ref, pages) -> List[float]:
+        if kind not in ["user", "critic"]:
+            return [frontier_priority(kind, _p) for _p in pages]
+        self.c.execute(f"SELECT released, metascore, final_{kind}_review_page_number "
+                       "FROM games WHERE rowid=?", (ref,))
+        game = self.c.fetchone() or (None, None, None)
+        return [frontier_priority(kind, _p, *game) for _p in pages]
+
+    # Existence checks - return rowid if exists else False; answered from
+    # self.index where it can say so without the database
+    def platform_exists(self, slug: str):
+        return self.index.platforms.get(slug, False)
+
+    def genre_exists(self, slug: str):
+        return self.index.genres.get(slug, False)
 
     def game_exists(self, slug, platform_pk):
-        self.c.execute("SELECT rowid FROM games WHERE slug=? AND platform=?",
-                       (slug, platform_pk))
-        result = self.c.fetchone()
-        return result[0] if result else False
+        return self.index.games.get((slug, platform_pk), False)
 
     def game_genre_association_exists(self, game_pk, genre_pk):
         self.c.execute("SELECT rowid FROM games_to_genres WHERE game=? AND genre=?",
                        (game_pk, genre_pk))
+        result = self.c.fetchone()
+        return result[0] if result else False
 
     def user_review_exists(self, review_id: str):
         self.c.execute("SELECT rowid FROM user_reviews WHERE review_id=?",
@@ -219,52 +702,257 @@ class Interface:
         return result[0] if result else False
 
     def platform_genre_crawl_url_exists(self, url):
-        self.c.execute("SELECT rowid FROM platform_genre_crawls WHERE url=?",
-                       (url,))    
-        result = self.c.fetchone()
-        return result[0] if result else False
+        crawl = self.index.crawls.get(url)
+        return crawl[0] if crawl else False
     
-    # Row insertion
-    def new_game(self, title, slug, platform, released, metascore) -> bool:
-        if self.game_exists(slug, platform):
-            return False
+    # Row insertion - return rowid if inserted else False
+    def new_game(self, title, slug, platform, released, metascore):
         self.c.execute("INSERT INTO games (title, slug, platform, released, metascore) "
-                       "VALUES (?,?,?,?,?)",
+                       "VALUES (?,?,?,?,?) "
+                       "ON CONFLICT (slug, platform) DO NOTHING",
                        (title, slug, platform, released, metascore))
         self.conn.commit()
-        return self.c.lastrowid
+        rowid = self.c.lastrowid if self.c.rowcount == 1 else False
+        self.index.sync_games(self.c)
+        return rowid
 
     def new_game_genre_association(self, game_pk, genre_pk):
-        if self.game_genre_association_exists(game_pk, genre_pk):
-            return False
-        self.c.execute("INSERT INTO games_to_genres (game, genre) VALUES (?,?)",
+        self.c.execute("INSERT INTO games_to_genres (game, genre) VALUES (?,?) "
+                       "ON CONFLICT (game, genre) DO NOTHING",
                        (game_pk, genre_pk))
+        self.conn.commit()
+        return self.c.lastrowid if self.c.rowcount == 1 else False
 
     def new_critic_review(self, game_pk, author, date, grade, body):
-        if self.critic_review_exists(author, date):
-            return False
         self.c.execute("INSERT INTO critic_reviews "
                        "(game, author, date, grade, body) "
-                       "VALUES (?,?,?,?,?)",
-                       (game_pk, author, date, grade, body))
+                       "VALUES (?,?,?,?,?) "
+                       "ON CONFLICT (author, date) DO NOTHING",
+                       (game_pk, author, date, grade,
+                        self.codec.encode("critic_reviews", body)))
         self.conn.commit()
+        return self.c.lastrowid if self.c.rowcount == 1 else False
 
     def new_user_review(self, game_pk, review_id, author, date, grade, body,
                               votes_total, votes_helpful):
-        if self.user_review_exists(review_id):
-            return False
         self.c.execute("INSERT INTO user_reviews "
                        "(game, review_id, author, date, grade, body, votes_total, votes_helpful) "
-                       "VALUES (?,?,?,?,?,?,?,?)",
-                       (game_pk, review_id, author, date, grade, body, votes_total, votes_helpful))
+                       "VALUES (?,?,?,?,?,?,?,?) "
+                       "ON CONFLICT (review_id) DO NOTHING",
+                       (game_pk, review_id, author, date, grade,
+                        self.codec.encode("user_reviews", body), votes_total, votes_helpful))
         self.conn.commit()
+        return self.c.lastrowid if self.c.rowcount == 1 else False
 
     def new_platform_genre_crawl_url(self, platform_pk, genre_pk, url: str):
-        if self.platform_genre_crawl_url_exists(url):
-            return False
-        self.c.execute("INSERT INTO platform_genre_crawls (platform, genre, url) "
-                       "VALUES (?,?,?)", (platform_pk, genre_pk, url))
-        self.conn.commit()
+        with self.conn:
+            self.c.execute("INSERT INTO platform_genre_crawls (platform, genre, url) "
+                           "VALUES (?,?,?) "
+                           "ON CONFLICT (url) DO NOTHING", (platform_pk, genre_pk, url))
+            if self.c.rowcount != 1:
+                return False
+            rowid = self.c.lastrowid
+            self._push_frontier_pages("last_page", rowid, 0, 0)
+        self.index.crawls[url] = (rowid, platform_pk, genre_pk)
+        return rowid
+
+    # Page-level batch writes - a page's rows and its progress marker are
+    # committed in one transaction; return the number of new rows. Rows may
+    # be any iterable, so a page still being parsed is inserted as its items
+    # arrive, and final_page_number a callable read once they are all in.
+    def write_games_page(self, url, page, games: Iterable[dict], platform_pk, genre_pk) -> int:
+        slugs = []
+        with self.conn:
+            self.c.executemany("INSERT INTO games (title, slug, platform, released, metascore) "
+                               "VALUES (:title,:slug,:platform,:released,:metascore) "
+                               "ON CONFLICT (slug, platform) DO NOTHING",
+                               (dict(_g, platform=platform_pk)
+                                for _g in _recording(games, slugs, lambda _g: _g["slug"])))
+            inserted = self.c.rowcount
+            self.c.executemany("INSERT INTO games_to_genres (game, genre) "
+                               "SELECT rowid, ? FROM games WHERE slug=? AND platform=? "
+                               "ON CONFLICT (game, genre) DO NOTHING",
+                               [(genre_pk, _s, platform_pk) for _s in slugs])
+            for kind in ["user", "critic"]:
+                self.c.executemany("INSERT INTO frontier (kind, ref, page, priority) "
+                                   "SELECT ?1, rowid, 0, frontier_priority(?1, 0, released, "
+                                   "  metascore, NULL, 0) "
+                                   "FROM games WHERE slug=? AND platform=? "
+                                   "ON CONFLICT (kind, ref, page) DO NOTHING",
+                                   [(kind, _s, platform_pk) for _s in slugs])
+            self.c.execute("UPDATE platform_genre_crawls "
+                           "SET last_page_scraped=MAX(COALESCE(last_page_scraped, -1), ?) "
+                           "WHERE url=?", (page, url))
+            crawl_pk = self.platform_genre_crawl_url_exists(url)
+            self._complete_frontier("titles", crawl_pk, page)
+        self.index.sync_games(self.c)
+        return inserted
+
+    def write_user_review_page(self, game_pk, page_number: int, reviews: Iterable[dict],
+                               final_page_number=None, push_pages=True) -> int:
+        with self.conn:
+            self.c.executemany("INSERT INTO user_reviews "
+                               "(game, review_id, author, date, grade, body, votes_total, votes_helpful) "
+                               "VALUES (:game,:review_id,:author,:date,:grade,:body,:votes_total,:votes_helpful) "
+                               "ON CONFLICT (review_id) DO NOTHING",
+                               (dict(_r, game=game_pk,
+                                     body=self.codec.encode("user_reviews", _r["body"]))
+                                for _r in reviews))
+            inserted = self.c.rowcount     # excludes the index and aggregate triggers' writes
+            if callable(final_page_number):
+                final_page_number = final_page_number()
+            if final_page_number is not None:
+                self.c.execute("UPDATE games SET final_user_review_page_number=? "
+                               "WHERE rowid=?", (int(final_page_number), game_pk))
+                if push_pages:
+                    self._push_frontier_pages("user", game_pk, 1, int(final_page_number))
+            self.c.execute("UPDATE games SET last_user_review_page_scraped="
+                           "MAX(COALESCE(last_user_review_page_scraped, -1), ?) "
+                           "WHERE rowid=?", (page_number, game_pk))
+            self._complete_frontier("user", game_pk, page_number)
+        return inserted
+
+    def write_critic_review_page(self, game_pk, page_number: int, reviews: Iterable[dict],
+                                 final_page_number=None, push_pages=True) -> int:
+        with self.conn:
+            self.c.executemany("INSERT INTO critic_reviews "
+                               "(game, author, date, grade, body) "
+                               "VALUES (:game,:author,:date,:grade,:body) "
+                               "ON CONFLICT (author, date) DO NOTHING",
+                               (dict(_r, game=game_pk,
+                                     body=self.codec.encode("critic_reviews", _r["body"]))
+                                for _r in reviews))
+            inserted = self.c.rowcount
+            if callable(final_page_number):
+                final_page_number = final_page_number()
+            if final_page_number is not None:
+                self.c.execute("UPDATE games SET final_critic_review_page_number=? "
+                               "WHERE rowid=?", (int(final_page_number), game_pk))
+                if push_pages:
+                    self._push_frontier_pages("critic", game_pk, 1, int(final_page_number))
+            self.c.execute("UPDATE games SET last_critic_review_page_scraped="
+                           "MAX(COALESCE(last_critic_review_page_scraped, -1), ?) "
+                           "WHERE rowid=?", (page_number, game_pk))
+            self._complete_frontier("critic", game_pk, page_number)
+        return inserted
+
+    # Full-text search - FTS5 indexes over review bodies, ranked by bm25
+    def search_reviews(self, query: str, review_type: str = "user", game_pk=None,
+                       platform=None, min_grade: int = None, max_grade: int = None,
+                       limit: int = 50) -> List[tuple]:
+        """Return [(rowid, rank)] of the reviews matching an FTS5 query, best
+        match first; rank is bm25, lower is better. platform is a slug."""
+        if review_type not in ["critic", "user"]:
+            raise RuntimeError
+        table = f"{review_type}_reviews"
+        where, params = [f"{table}_fts MATCH ?"], [query]
+        if game_pk is not None:
+            where.append("r.game=?")
+            params.append(game_pk)
+        if platform is not None:
+            where.append("r.game IN (SELECT rowid FROM games WHERE platform=?)")
+            params.append(self.platform_exists(platform))
+        if min_grade is not None:
+            where.append("r.grade>=?")
+            params.append(min_grade)
+        if max_grade is not None:
+            where.append("r.grade<=?")
+            params.append(max_grade)
+        self.c.execute(f"SELECT f.rowid, f.rank FROM {table}_fts f "
+                       f"JOIN {table} r ON r.rowid=f.rowid "
+                       f"WHERE {' AND '.join(where)} ORDER BY f.rank LIMIT ?",
+                       params + [limit])
+        return self.c.fetchall()
+
+    def rebuild_search_index(self):
+        """Re-read every review body into the full-text indexes and merge
+        their segments."""
+        with self.conn:
+            for table in ["user_reviews_fts", "critic_reviews_fts"]:
+                self.c.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+                self.c.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+
+    def get_reviews(self, review_type: str, rowids: List[int]) -> List[dict]:
+        """Rows of the given reviews, in rowids order, with their bodies as text."""
+        if review_type not in ["critic", "user"]:
+            raise RuntimeError
+        self.c.execute(f"SELECT rowid, *, body_text(body) FROM {review_type}_reviews "
+                       f"WHERE rowid IN ({','.join('?' * len(rowids))})", list(rowids))
+        columns = [_d[0] for _d in self.c.description][:-1]
+        rows = {_r[0]: dict(zip(columns, _r[:-1]), body=_r[-1]) for _r in self.c.fetchall()}
+        return [rows[_i] for _i in rowids if _i in rows]
+
+    # Compressed bodies - zstd with a dictionary trained per table; see compress.py
+    def compress_bodies(self, batch_size: int = 5000) -> dict:
+        """Train a dictionary for each review table that has none and
+        compress its plain bodies in place, batch by batch; return the
+        number of bodies compressed per table. Tables too small to train
+        on are left as they are. VACUUM afterwards to return the space."""
+        compressed = {}
+        for table in ["user_reviews", "critic_reviews"]:
+            if not self.codec.enabled(table):
+                self.c.execute(f"SELECT body_text(body) FROM {table} "
+                               f"ORDER BY RANDOM() LIMIT ?", (compress.TRAINING_SAMPLES,))
+                samples = [_r[0] for _r in self.c.fetchall()]
+                with self.conn:
+                    if self.codec.train(table, samples, self.c) is None:
+                        continue
+                    # From here the table may hold BLOBs the index must decode
+                    for statement in _search_index(table, compressed=True):
+                        self.c.execute(statement)
+            compressed[table] = 0
+            last_rowid = 0
+            while True:
+                self.c.execute(f"SELECT rowid, body FROM {table} "
+                               f"WHERE rowid > ? AND typeof(body)='text' "
+                               f"ORDER BY rowid LIMIT ?", (last_rowid, batch_size))
+                rows = self.c.fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                with self.conn:
+                    self.c.executemany(f"UPDATE {table} SET body=? WHERE rowid=?",
+                                       [(self.codec.encode(table, _b), _i) for _i, _b in rows])
+                compressed[table] += len(rows)
+        return compressed
+
+    def vacuum(self):
+        self.c.execute("VACUUM")
+
+    # Review aggregates - one row per game and review type, see AGGREGATE_COLUMNS
+    def get_review_aggregates(self, review_type: str, game_pks: List[int] = None) -> List[dict]:
+        """Aggregates of review_type for the given games, or every game,
+        with the mean grade, grade histogram and helpful-vote ratio."""
+        if review_type not in AGGREGATE_SOURCES:
+            raise RuntimeError
+        query = f"SELECT game, {', '.join(AGGREGATE_COLUMNS)} FROM review_aggregates " \
+                f"WHERE review_type=? AND reviews > 0"
+        params = [review_type]
+        if game_pks is not None:
+            query += f" AND game IN ({','.join('?' * len(game_pks))})"
+            params += list(game_pks)
+        self.c.execute(query + " ORDER BY game", params)
+        return [aggregate_row(_r) for _r in self.c.fetchall()]
+
+    def verify_review_aggregates(self) -> List[tuple]:
+        """Return the (game, review_type) pairs whose stored aggregates differ
+        from the ones recomputed from the review tables."""
+        stored = f"SELECT game, review_type, {', '.join(AGGREGATE_COLUMNS)} " \
+                 f"FROM review_aggregates WHERE reviews != 0"
+        self.c.execute(f"WITH expected (game, review_type, {', '.join(AGGREGATE_COLUMNS)}) "
+                       f"AS ({_aggregate_select('user')} UNION ALL "
+                       f"{_aggregate_select('critic')}) "
+                       f"SELECT game, review_type FROM ({stored} EXCEPT SELECT * FROM expected) "
+                       f"UNION SELECT game, review_type FROM "
+                       f"(SELECT * FROM expected EXCEPT {stored})")
+        return self.c.fetchall()
+
+    def rebuild_review_aggregates(self):
+        with self.conn:
+            self.c.execute("DELETE FROM review_aggregates")
+            self.c.execute(f"INSERT INTO review_aggregates "
+                           f"(game, review_type, {', '.join(AGGREGATE_COLUMNS)}) "
+                           f"{_aggregate_select('user')} UNION ALL {_aggregate_select('critic')}")
 
     # Progress tracking methods - final_page_number and last_page_scraped
     def update_genre_crawl_complete(self, platform_slug):
@@ -289,10 +977,13 @@ class Interface:
         self.conn.commit()
 
     def add_final_platform_genre_page_number(self, url, number):
-        self.c.execute("UPDATE platform_genre_crawls "
-                       "SET final_page_number=? WHERE url=?",
-                       (number, url))
-        self.conn.commit()
+        with self.conn:
+            self.c.execute("UPDATE platform_genre_crawls "
+                           "SET final_page_number=? WHERE url=?",
+                           (number, url))
+            crawl_pk = self.platform_genre_crawl_url_exists(url)
+            self._push_frontier_pages("titles", crawl_pk, 0, int(number))
+            self._complete_frontier("last_page", crawl_pk, 0)
 
     def update_last_platform_genre_page_scraped(self, url, number):
         self.c.execute("UPDATE platform_genre_crawls "
@@ -1,8 +1,26 @@
-from datetime import datetime
+import codecs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from importlib.util import find_spec
+import json
+import os
 from random import randint
-import requests
-from time import sleep
+import threading
+from time import monotonic, sleep
+from typing import Iterable, Iterator, Tuple, TYPE_CHECKING
 
+from app import metrics
+
+
+if TYPE_CHECKING:
+    import requests
+
+# requests is imported with the first session, not at startup; urllib3
+# decodes "br" responses when brotli is installed
+ACCEPT_ENCODING = "gzip, deflate, br" if find_spec("brotli") else "gzip, deflate"
+
+CHUNK_BYTES = 16384
+# Statuses that mean a page is not coming back, unlike timeouts and 5xx
+GONE_STATUSES = [404, 410]
 
 HEADERS = [
     {"User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/56.0.2924.76 Safari/537.36",
@@ -10,46 +28,353 @@ HEADERS = [
      "DNT": "1",
      "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
      "Accept-Language": "en-US,en;q=0.5",
-     "Accept-Encoding": "gzip, deflate"}
+     "Accept-Encoding": ACCEPT_ENCODING}
 ]
 
 
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, jitter: float = 0) -> float:
+        """Reserve one token, plus `jitter` seconds of budget; return the
+        seconds to wait before using it."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1 + jitter * self.rate
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self, jitter: float = 0) -> float:
+        """Reserve one token, plus `jitter` seconds of budget, and wait for it."""
+        wait = self.reserve(jitter)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def set_rate(self, rate: float) -> None:
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = rate
+
+
+class AdaptiveThrottle:
+    """AIMD controller for a TokenBucket's rate.
+
+    Each healthy response raises the rate by `increase` requests/second;
+    a 429, 5xx, connection failure or latency spike multiplies it by
+    `decrease`, at most once per cooldown so one burst of failures from
+    concurrent workers only counts once. The learned rate is saved to
+    `state_path` so a restart resumes from it.
+    """
+
+    def __init__(self, bucket: TokenBucket, min_rate: float, max_rate: float,
+                 increase: float = 0.01, decrease: float = 0.5,
+                 spike_factor: float = 3, state_path: str = None):
+        self.bucket = bucket
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.spike_factor = spike_factor
+        self.state_path = state_path
+        self.latency = None
+        self.samples = 0
+        self.last_decrease = 0
+        self.last_save = 0
+        self.lock = threading.Lock()
+        self.bucket.set_rate(self.clamp(self.load()))
+
+    def clamp(self, rate: float) -> float:
+        return max(self.min_rate, min(self.max_rate, rate))
+
+    def observe(self, status_code, latency: float) -> None:
+        """Adjust the rate from one response; status_code None is a failure."""
+        with self.lock:
+            healthy = status_code is not None \
+                and status_code != 429 and status_code < 500
+            if healthy and self.samples >= 5 \
+                    and latency > self.spike_factor * self.latency:
+                healthy = False
+            if healthy:
+                self.latency = latency if self.latency is None \
+                    else 0.8 * self.latency + 0.2 * latency
+                self.samples += 1
+                rate = self.bucket.rate + self.increase
+            else:
+                now = monotonic()
+                cooldown = max(1 / self.bucket.rate, self.latency or 0)
+                if now - self.last_decrease < cooldown:
+                    return
+                self.last_decrease = now
+                rate = self.bucket.rate * self.decrease
+            self.bucket.set_rate(self.clamp(rate))
+            if not healthy or monotonic() - self.last_save > 60:
+                self.save()
+
+    def load(self) -> float:
+        if not self.state_path or not os.path.isfile(self.state_path):
+            return self.min_rate
+        try:
+            with open(self.state_path) as f:
+                return float(json.load(f)["rate"])
+        except (ValueError, KeyError, OSError):
+            return self.min_rate
+
+    def save(self) -> None:
+        self.last_save = monotonic()
+        if not self.state_path:
+            return
+        with open(f"{self.state_path}.tmp", "w") as f:
+            json.dump({"rate": self.bucket.rate}, f)
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+
+
+class RetryBudget:
+    """Cap retries at a fraction of recent requests, plus a small reserve."""
+
+    def __init__(self, ratio: float = 0.1, reserve: float = 10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.balance = reserve
+        self.lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self.lock:
+            self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
 class Interface:
 
-    def __init__(self, logger, throttle_seconds=10):
+    def __init__(self, logger, throttle_seconds=10, min_throttle_seconds=1,
+                 max_workers=4, max_retries=5, backoff_seconds=2,
+                 backoff_max_seconds=120, timeout_seconds=60, state_path=None,
+                 archive=None, bucket=None, throttler=None):
         self.log = logger
+        self.archive = archive
         self.throttle_seconds = throttle_seconds
-        self.last_fetch = 0
+        self.min_throttle_seconds = min_throttle_seconds
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.timeout_seconds = timeout_seconds
+        # A bucket and throttler passed in are shared with other processes
+        self.bucket = bucket
+        self.throttler = throttler
+        if bucket is None and throttle_seconds:
+            self.bucket = TokenBucket(1 / throttle_seconds)
+            self.throttler = AdaptiveThrottle(self.bucket,
+                                              min_rate=1 / throttle_seconds,
+                                              max_rate=1 / min_throttle_seconds,
+                                              state_path=state_path)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix="fetch")
+        self._session = None
+        self.session_lock = threading.Lock()
+        self.retry_budget = RetryBudget()
+        self.counters = {"requests": 0, "retries": 0, "retries_denied": 0, "not_modified": 0,
+                         "body_errors": 0}
+        self.counters_lock = threading.Lock()
+        self.gone_urls = set()
 
+    @property
+    def session(self) -> "requests.Session":
+        with self.session_lock:
+            if self._session is None:
+                self._session = self.make_session()
+            return self._session
+
+    def make_session(self) -> "requests.Session":
+        """Return a session whose keep-alive pool has a slot per worker."""
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.headers.update(HEADERS[0])
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.max_workers,
+                              pool_block=True, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @metrics.timed("fetch")
     def fetch(self, url: str) -> str:
         """Return the HTML contained in HTTP response."""
-        self.throttle()
-        self.log.debug(f"Attempting to fetch {url}.")
-        resp = requests.get(url, headers=HEADERS[0])
-        self.update_last_fetch()
-        if resp.url != url:
-            self.log.critical("Data label integrity threatened by unexpected redirection detected. Aborting.")
-            raise RuntimeError
-        self.log.debug(f"HTTP status code {resp.status_code}")
-        if not resp.status_code == 200:
-            if str(resp.status_code).startswith("5"):
-                self.log.debug("5XX status encountered. Retrying.")
-                self.throttle()
-                return self.fetch(url)
-            return None
-        return resp.content.decode()
+        return self.fetch_chunks(url, stream=False)
+
+    def fetch_chunks(self, url: str, stream: bool = True):
+        """Return the page at url as an iterator of decoded chunks, read off
+        the connection as they are consumed, or None on failure.
+
+        With stream=False the body is read before returning and the joined
+        HTML is returned instead, so a connection dropped mid-body is retried.
+        """
+        import requests
+        for attempt in range(self.max_retries + 1):
+            self.throttle()
+            self.log.debug("Attempting to fetch %s.", url)
+            self.count("requests")
+            self.retry_budget.deposit()
+            headers, latest = {}, self.archive.latest(url) if self.archive else None
+            if latest and latest[1]:
+                headers["If-None-Match"] = latest[1]
+            if latest and latest[2]:
+                headers["If-Modified-Since"] = latest[2]
+            try:
+                with metrics.timer("http_get"):
+                    resp = self.session.get(url, headers=headers, stream=True,
+                                            timeout=self.timeout_seconds)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.log.debug("%s encountered.", type(e).__name__)
+                self.observe(None, self.timeout_seconds)
+            else:
+                self.observe(resp.status_code, resp.elapsed.total_seconds())
+                metrics.count(f"http_status_{resp.status_code}")
+                if resp.url != url:
+                    resp.close()
+                    self.log.critical("Data label integrity threatened by unexpected redirection detected. Aborting.")
+                    raise RuntimeError
+                self.log.debug("HTTP status code %s", resp.status_code)
+                if resp.status_code == 200:
+                    if stream:
+                        return self.read(url, resp)
+                    try:
+                        return "".join(self.read(url, resp))
+                    except requests.RequestException as e:
+                        self.log.debug("%s encountered reading body.", type(e).__name__)
+                        self.count("body_errors")
+                else:
+                    resp.close()
+                    if resp.status_code == 304 and latest:
+                        self.count("not_modified")
+                        html = self.archive.load(latest[0])
+                        return iter([html]) if stream else html
+                    if resp.status_code in GONE_STATUSES:
+                        with self.counters_lock:
+                            self.gone_urls.add(url)
+                    if not (resp.status_code == 429 or str(resp.status_code).startswith("5")):
+                        return None
+                    self.log.debug("%s status encountered.", resp.status_code)
+            if attempt == self.max_retries:
+                break
+            if not self.retry_budget.withdraw():
+                self.count("retries_denied")
+                self.log.warning("Retry budget exhausted. Giving up on %s.", url)
+                return None
+            self.count("retries")
+            delay = self.backoff(attempt)
+            self.log.debug("Retrying in %.1fs.", delay)
+            sleep(delay)
+        self.log.warning("Giving up on %s after %s retries.", url, self.max_retries)
+        return None
+
+    def gone(self, url: str) -> bool:
+        """True, once, if url's last fetch failed for good with 404 or 410."""
+        with self.counters_lock:
+            if url in self.gone_urls:
+                self.gone_urls.remove(url)
+                return True
+            return False
+
+    def read(self, url: str, resp: "requests.Response") -> Iterator[str]:
+        """Decode resp's body chunk by chunk, archiving it as it goes; the
+        archive only records bodies that were read to the end."""
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        writer = self.archive.open(url, etag=resp.headers.get("ETag"),
+                                   last_modified=resp.headers.get("Last-Modified")) \
+            if self.archive else None
+        try:
+            for data in resp.iter_content(CHUNK_BYTES):
+                if writer:
+                    writer.write(data)
+                text = decoder.decode(data)
+                if text:
+                    yield text
+            text = decoder.decode(b"", final=True)
+            if text:
+                yield text
+            if writer:
+                writer.close()
+                writer = None
+        finally:
+            resp.close()
+            if writer:
+                writer.abort()
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff capped at backoff_max_seconds, with fuzz."""
+        delay = min(self.backoff_max_seconds, self.backoff_seconds * 2 ** attempt)
+        return self.additive_fuzz(delay, 0, 1)
+
+    def fetch_many(self, urls: Iterable[str]) -> Iterator[Tuple[str, str]]:
+        """Fetch URLs concurrently, yielding (url, html) pairs as they complete.
+
+        At most max_workers requests are in flight; all workers share the
+        same token bucket, so the politeness budget is unchanged.
+        """
+        futures = {self.pool.submit(self.fetch, url): url for url in urls}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
 
     def throttle(self) -> None:
-        """Restrict HTTP GETs to no more than once per throttle_seconds."""
+        """Restrict HTTP GETs to the adaptive rate plus 0-30% of fuzz."""
+        if not self.bucket:
+            return
         self.log.debug("Throttling...")
-        delta = int(datetime.now().timestamp()) - self.last_fetch
-        if delta < self.throttle_seconds:
-            interval = self.additive_fuzz(self.throttle_seconds, 0, 3)
-            sleep(int(self.throttle_seconds - delta))
+        interval = 1 / self.bucket.rate
+        waited = self.bucket.acquire(jitter=interval * self.additive_fuzz(0, 0, 3) / 10)
+        metrics.observe("throttle_wait", waited)
+
+    def observe(self, status_code, latency: float) -> None:
+        if self.throttler:
+            self.throttler.observe(status_code, latency)
 
     def additive_fuzz(self, value: int, min: int, max: int) -> float:
         fuzz = randint(min*1000,max*1000)/1000
         return value + fuzz
 
-    def update_last_fetch(self) -> None:
-        self.last_fetch = int(datetime.now().timestamp())
\ No newline at end of file
+    def count(self, name: str) -> None:
+        with self.counters_lock:
+            self.counters[name] += 1
+        metrics.count(f"http_{name}")
+
+    def stats(self) -> dict:
+        """Return request/retry counters and keep-alive connection reuse."""
+        opened = served = 0
+        adapters = self._session.adapters.values() if self._session else []
+        for adapter in {id(_a): _a for _a in adapters}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                opened += pools[key].num_connections
+                served += pools[key].num_requests
+        stats = dict(self.counters)
+        stats["connections_opened"] = opened
+        stats["connections_reused"] = max(0, served - opened)
+        if self.bucket:
+            stats["rate"] = round(self.bucket.rate, 4)
+        return stats
+
+    def close(self) -> None:
+        if self.throttler:
+            self.throttler.save()
+        self.pool.shutdown(wait=True)
+        if self._session:
+            self._session.close()
@@ -0,0 +1,124 @@
+import argparse
+import json
+import os
+from time import time
+
+import numpy as np
+
+from app import SqliteInterface
+
+
+# Column store - numeric columns as memory-mapped .npy files, one per
+# column, described by manifest.json. NULLs are stored as the column's
+# null value. Queries read a consistent snapshot of each table.
+COLUMNS = {
+    "games": (
+        "SELECT rowid, platform, metascore FROM games ORDER BY rowid",
+        [("game", "int32", None), ("platform", "int16", None), ("metascore", "int16", -1)],
+    ),
+    "user_reviews": (
+        "SELECT u.review_id, u.game, u.grade, u.votes_total, u.votes_helpful, {english}"
+        "  FROM user_reviews u {join} ORDER BY u.rowid",
+        [("review_id", "int64", None), ("game", "int32", None), ("grade", "int8", -1),
+         ("votes_total", "int32", None), ("votes_helpful", "int32", None),
+         ("english", "int8", -1)],     # 1 or 0 once tagged by make_language_table
+    ),
+}
+MANIFEST = "manifest.json"
+
+
+def export_columns(out_path="columns", data_path=".", chunk_size=100000):
+    """Write COLUMNS to out_path, replacing any earlier export."""
+    db = SqliteInterface.Interface(data_path)
+    os.makedirs(out_path, exist_ok=True)
+    db.c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='language'")
+    has_language = db.c.fetchone() is not None
+    manifest = {"created_at": time(), "tables": {}}
+    db.c.execute("BEGIN")     # counts and rows from one snapshot
+    for table, (query, columns) in COLUMNS.items():
+        # One language per review, even in a table tagged before
+        # language_review deduplicated it; the arrays hold COUNT(*) rows
+        query = query.format(english="l.english" if has_language else "NULL",
+                             join="LEFT JOIN (SELECT review, MIN(lang)='en' AS english"
+                                  "  FROM language GROUP BY review) l ON l.review=u.review_id"
+                                  if has_language else "")
+        rows = db.c.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        arrays = [np.lib.format.open_memmap(f"{out_path}/{table}.{_c}.npy.tmp", mode="w+",
+                                            dtype=_d, shape=(rows,))
+                  for _c, _d, _ in columns]
+        filled = 0
+        db.c.execute(query)
+        while True:
+            chunk = db.c.fetchmany(chunk_size)
+            if not chunk:
+                break
+            for array, (_, dtype, null), values in zip(arrays, columns, zip(*chunk)):
+                array[filled:filled + len(chunk)] = np.fromiter(
+                    (null if _v is None else _v for _v in values), dtype, len(chunk))
+            filled += len(chunk)
+        manifest["tables"][table] = {"rows": rows, "columns": {}}
+        for array, (column, dtype, null) in zip(arrays, columns):
+            array.flush()
+            path = f"{out_path}/{table}.{column}.npy"
+            os.replace(f"{path}.tmp", path)
+            manifest["tables"][table]["columns"][column] = {
+                "file": os.path.basename(path), "dtype": dtype, "null": null}
+        print(f"{rows} rows exported from {table}.")
+    db.conn.commit()
+    with open(f"{out_path}/{MANIFEST}.tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f"{out_path}/{MANIFEST}.tmp", f"{out_path}/{MANIFEST}")
+    return manifest
+
+
+class ColumnStore:
+    """An export_columns directory, opened read-only without loading it:
+    store["user_reviews"]["grade"] is a memory-mapped array."""
+
+    def __init__(self, path="columns"):
+        with open(f"{path}/{MANIFEST}") as f:
+            self.manifest = json.load(f)
+        self.tables = {
+            table: {column: np.load(f"{path}/{spec['file']}", mmap_mode="r")
+                    for column, spec in info["columns"].items()}
+            for table, info in self.manifest["tables"].items()}
+
+    def __getitem__(self, table: str) -> dict:
+        return self.tables[table]
+
+    def present(self, table: str, column: str) -> np.ndarray:
+        """Mask of the rows where column is not NULL."""
+        null = self.manifest["tables"][table]["columns"][column]["null"]
+        values = self.tables[table][column]
+        return np.ones(len(values), dtype=bool) if null is None else values != null
+
+    def per_review(self, column: str) -> np.ndarray:
+        """A games column aligned with user_reviews, e.g. each review's platform."""
+        games, reviews = self.tables["games"], self.tables["user_reviews"]
+        return games[column][np.searchsorted(games["game"], reviews["game"])]
+
+
+# Vectorized filters
+def grade_buckets(grades: np.ndarray, low: int = 4, high: int = 6) -> tuple:
+    """(negative, positive) masks: grades below low and above high, leaving
+    out the neutral low..high band and NULL (-1) grades."""
+    return (grades >= 0) & (grades < low), grades > high
+
+
+def simple_binary(store: ColumnStore, english_only: bool = True) -> dict:
+    """The negative and positive user review ids of makedb_simple_binary."""
+    reviews = store["user_reviews"]
+    negative, positive = grade_buckets(reviews["grade"])
+    if english_only:
+        english = reviews["english"] == 1
+        negative, positive = negative & english, positive & english
+    return {"negative": reviews["review_id"][negative],
+            "positive": reviews["review_id"][positive]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export numeric columns for analysis.")
+    parser.add_argument("--data-path", default=".")
+    parser.add_argument("--out", default="columns")
+    args = parser.parse_args()
+    export_columns(args.out, args.data_path)
@@ -0,0 +1,84 @@
+from importlib.util import find_spec
+import sqlite3
+from time import time
+
+
+# zstandard is only needed once a database has been compressed
+AVAILABLE = find_spec("zstandard") is not None
+LEVEL = 9
+DICTIONARY_BYTES = 112640
+TRAINING_SAMPLES = 20000
+MIN_TRAINING_SAMPLES = 1000
+
+
+class BodyCodec:
+    """zstd compression of review bodies with a trained dictionary per table.
+
+    A compressed body is stored as a BLOB and a plain one as TEXT, so both
+    can share a column while a database is being converted. Each frame
+    records the id of the dictionary it was compressed with, and every
+    dictionary is kept, so bodies from older dictionaries stay readable
+    after a retrain. A table without a dictionary is written uncompressed.
+    """
+
+    def __init__(self, level: int = LEVEL):
+        self.level = level
+        self.dictionaries = {}
+        self.latest = {}
+        self.compressors = {}
+        self.decompressors = {}
+
+    def load(self, c: sqlite3.Cursor) -> "BodyCodec":
+        for dict_id, table, data in c.execute("SELECT id, table_name, data "
+                                              "FROM body_dictionaries ORDER BY created_at"):
+            self.dictionaries[dict_id] = data
+            self.latest[table] = dict_id
+        return self
+
+    def enabled(self, table: str) -> bool:
+        return table in self.latest
+
+    def encode(self, table: str, body: str):
+        """body compressed with table's latest dictionary, if it has one."""
+        dict_id = self.latest.get(table)
+        if dict_id is None or body is None:
+            return body
+        if dict_id not in self.compressors:
+            import zstandard
+            self.compressors[dict_id] = zstandard.ZstdCompressor(
+                level=self.level, dict_data=self.dictionary(dict_id),
+                write_checksum=False, write_content_size=True)
+        return self.compressors[dict_id].compress(body.encode())
+
+    def decode(self, body) -> str:
+        """The text of a stored body, compressed or not."""
+        if not isinstance(body, bytes):
+            return body
+        import zstandard
+        dict_id = zstandard.get_frame_parameters(body).dict_id
+        if dict_id not in self.decompressors:
+            self.decompressors[dict_id] = zstandard.ZstdDecompressor(
+                dict_data=self.dictionary(dict_id))
+        return self.decompressors[dict_id].decompress(body).decode()
+
+    def dictionary(self, dict_id: int):
+        import zstandard
+        if dict_id not in self.dictionaries:
+            raise RuntimeError
+        return zstandard.ZstdCompressionDict(self.dictionaries[dict_id])
+
+    def train(self, table: str, samples: list, c: sqlite3.Cursor) -> int:
+        """Train and store a new dictionary for table; return its id, or
+        None with too few samples to train on."""
+        if len(samples) < MIN_TRAINING_SAMPLES:
+            return None
+        import zstandard
+        trained = zstandard.train_dictionary(DICTIONARY_BYTES,
+                                             [_s.encode() for _s in samples],
+                                             level=self.level)
+        dict_id, data = trained.dict_id(), trained.as_bytes()
+        c.execute("INSERT INTO body_dictionaries (id, table_name, data, created_at) "
+                  "VALUES (?,?,?,?)", (dict_id, table, data, time()))
+        self.dictionaries[dict_id] = data
+        self.latest[table] = dict_id
+        return dict_id
@@ -0,0 +1,49 @@
+import sqlite3
+import sys
+
+
+class Index:
+    """In-process answers to the scraper's "already seen?" questions.
+
+    Platforms, genres, listing URLs and games are held exactly, warm-started
+    from SQLite by load(). Reviews are deduplicated by the UNIQUE indexes
+    their inserts conflict on, so no review keys are held here.
+    """
+
+    def __init__(self):
+        self.platforms = {}
+        self.platform_slugs = {}
+        self.genres = {}
+        self.crawls = {}
+        self.games = {}
+        self.games_rowid = 0
+
+    def load(self, c: sqlite3.Cursor) -> "Index":
+        for pk, slug in c.execute("SELECT rowid, slug FROM platforms").fetchall():
+            self.platforms[slug] = pk
+            self.platform_slugs[pk] = slug
+        self.genres = dict((_s, _pk) for _pk, _s in
+                           c.execute("SELECT rowid, slug FROM genres").fetchall())
+        for pk, url, platform, genre in c.execute(
+                "SELECT rowid, url, platform, genre FROM platform_genre_crawls").fetchall():
+            self.crawls[url] = (pk, platform, genre)
+        self.sync_games(c)
+        return self
+
+    def sync_games(self, c: sqlite3.Cursor) -> None:
+        """Pick up games inserted since the last sync."""
+        for pk, slug, platform in c.execute("SELECT rowid, slug, platform FROM games "
+                                            "WHERE rowid > ? ORDER BY rowid",
+                                            (self.games_rowid,)).fetchall():
+            self.games[(slug, platform)] = pk
+            self.games_rowid = pk
+
+    def memory(self) -> dict:
+        """Approximate bytes held by each structure."""
+        def size(d: dict) -> int:
+            return sys.getsizeof(d) + sum(sys.getsizeof(_k) + sys.getsizeof(_v)
+                                          for _k, _v in d.items())
+        return {"platforms": size(self.platforms) + size(self.platform_slugs),
+                "genres": size(self.genres),
+                "crawls": size(self.crawls),
+                "games": size(self.games)}
@@ -0,0 +1,243 @@
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+import threading
+from time import monotonic, sleep
+from typing import Callable, List
+from uuid import uuid4
+
+from app import ArchiveInterface
+from app import logs
+from app import metrics
+from app import parse
+from app import pipeline
+from app import WebInterface
+
+
+KINDS = ["last_page", "titles", "user", "critic"]
+
+
+class CoordinatorManager(BaseManager):
+    pass
+
+
+class Coordinator:
+    """Owns the database, frontier leases and global request rate for a
+    set of worker processes.
+
+    Every database call runs on one writer thread, so the SQLite
+    connection keeps a single owner however many workers are connected.
+    Workers lease frontier pages with claim(), keep the leases alive with
+    heartbeat() and hand parsed pages back with submit(). A worker silent
+    for longer than lease_seconds has its pages released for others.
+    """
+
+    def __init__(self, make_app: Callable, lease_seconds: float = 120,
+                 heartbeat_seconds: float = 30):
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+        self.app = self.writer.submit(make_app).result()
+        self.log = self.app.get_logger("Coordinator")
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.workers = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reaper = threading.Thread(target=self.reap, name="reaper", daemon=True)
+
+    def write(self, fn: Callable, *args):
+        """Run fn on the writer thread and return its result."""
+        return self.writer.submit(fn, *args).result()
+
+    # Worker-facing API - exposed through CoordinatorManager
+    def register(self) -> dict:
+        worker_id = uuid4().hex[:8]
+        with self.lock:
+            self.workers[worker_id] = {"seen": monotonic(), "leases": set()}
+        self.log.info("Worker %s registered.", worker_id)
+        return {"worker_id": worker_id, "heartbeat_seconds": self.heartbeat_seconds}
+
+    def claim(self, worker_id: str, kinds: List[str], count: int) -> List:
+        """Lease up to count pages to a worker, as [(crawl, url)] pairs."""
+        def claim():
+            crawls = self.app.db.claim_frontier(kinds, count, self.lease_seconds)
+            return [(_c, self.app.crawl_url(_c), self.app.frontier_key(_c)) for _c in crawls]
+        claimed = self.write(claim)
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                # Reaped meanwhile; hand the pages straight back
+                self.write(lambda: [self.app.db.release_frontier(*_k) for _, _, _k in claimed])
+                return []
+            worker["seen"] = monotonic()
+            worker["leases"].update(_k for _, _, _k in claimed)
+        return [(_c, _url) for _c, _url, _ in claimed]
+
+    def heartbeat(self, worker_id: str) -> bool:
+        """Renew a worker's leases; False if it was reaped and must re-register."""
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                return False
+            worker["seen"] = monotonic()
+            keys = list(worker["leases"])
+        self.write(self.app.db.renew_frontier, keys, self.lease_seconds)
+        return True
+
+    def submit(self, worker_id: str, crawl: List, scraped: dict, gone: bool = False) -> bool:
+        """Store a worker's parsed page; scraped is None if the fetch failed,
+        for good if gone."""
+        def write():
+            self.app.write_page(crawl, None, scraped, gone)
+            return self.app.frontier_key(crawl)
+        key = self.write(write)
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is not None:
+                worker["seen"] = monotonic()
+                worker["leases"].discard(key)
+        return True
+
+    def leave(self, worker_id: str) -> None:
+        self.drop(worker_id)
+        self.log.info("Worker %s left.", worker_id)
+
+    def reserve(self, jitter: float = 0) -> tuple:
+        """Reserve a request from the global budget; return (wait, rate)."""
+        bucket = self.app.web.bucket
+        if bucket is None:
+            return 0, None
+        return bucket.reserve(jitter), bucket.rate
+
+    def observe(self, status_code, latency: float) -> None:
+        self.app.web.observe(status_code, latency)
+
+    def done(self) -> bool:
+        """True once no frontier page is pending or claimed."""
+        stats = self.write(self.app.db.frontier_stats)
+        return not any(_s.get(0) or _s.get(1) for _s in stats.values())
+
+    # Coordinator side
+    def drop(self, worker_id: str) -> None:
+        """Forget a worker and release the pages it still held."""
+        with self.lock:
+            worker = self.workers.pop(worker_id, None)
+        if worker:
+            self.write(lambda: [self.app.db.release_frontier(*_k) for _k in worker["leases"]])
+
+    def reap(self) -> None:
+        while not self.stopped.wait(self.heartbeat_seconds):
+            with self.lock:
+                silent = [_w for _w, _s in self.workers.items()
+                          if monotonic() - _s["seen"] > self.lease_seconds]
+            for worker_id in silent:
+                self.log.warning("Worker %s stopped heartbeating; releasing its pages.",
+                                 worker_id)
+                self.drop(worker_id)
+
+    def serve(self, address: tuple, authkey: bytes) -> None:
+        """Seed the frontier, serve workers until it is exhausted and all
+        workers have left, then close the app."""
+        self.write(self.app.populate_title_by_genre_urls_to_crawl)
+        CoordinatorManager.register("coordinator", callable=lambda: self)
+        server = CoordinatorManager(address=address, authkey=authkey).get_server()
+        # serve_forever() calls sys.exit() when stopped, so keep it off the main thread
+        threading.Thread(target=server.serve_forever, name="server", daemon=True).start()
+        self.reaper.start()
+        self.log.info("Coordinating workers on %s:%s.", *server.address)
+        while not (self.done() and not self.workers):
+            sleep(self.heartbeat_seconds / 10)
+        self.stopped.set()
+        self.log.info("Frontier: %s", self.write(self.app.db.frontier_stats))
+        self.write(self.app.close)
+        self.writer.shutdown()
+
+
+class RemoteBucket:
+    """TokenBucket interface drawing on the coordinator's global budget."""
+
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        self.rate = float("inf")
+
+    def reserve(self, jitter: float = 0) -> float:
+        wait, rate = self.coordinator.reserve(jitter)
+        self.rate = rate or float("inf")
+        return wait
+
+    def acquire(self, jitter: float = 0) -> float:
+        wait = self.reserve(jitter)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+
+class RemoteThrottle:
+    """AdaptiveThrottle interface reporting responses to the coordinator."""
+
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+
+    def observe(self, status_code, latency: float) -> None:
+        self.coordinator.observe(status_code, latency)
+
+    def save(self) -> None:
+        pass
+
+
+class Worker:
+    """Fetches and parses pages leased from a Coordinator, which stores them."""
+
+    def __init__(self, address: tuple, authkey: bytes, data_path: str = ".",
+                 workers: int = 4, parse_workers: int = 2, archive_path: str = None,
+                 idle_seconds: float = 5):
+        CoordinatorManager.register("coordinator")
+        manager = CoordinatorManager(address=address, authkey=authkey)
+        manager.connect()
+        self.coordinator = manager.coordinator()
+        info = self.coordinator.register()
+        self.worker_id = info["worker_id"]
+        self.heartbeat_seconds = info["heartbeat_seconds"]
+        self.idle_seconds = idle_seconds
+        self.log = logs.get_logger(f"Worker {self.worker_id}")
+        # Requests are paced by the coordinator's bucket; conditional GETs
+        # use validators from this worker's own archive
+        self.web = WebInterface.Interface(logs.get_logger("WebInterface"),
+                                          max_workers=workers,
+                                          archive=ArchiveInterface.Interface(
+                                              archive_path or f"{data_path}/archive"),
+                                          bucket=RemoteBucket(self.coordinator),
+                                          throttler=RemoteThrottle(self.coordinator))
+        self.pipeline = pipeline.Pipeline(self.log, self.web.fetch, parse.scrape_page,
+                                          fetch_workers=workers, parse_workers=parse_workers,
+                                          capacity=workers * 4)
+        self.metrics = metrics.Flusher(metrics.REGISTRY,
+                                       f"{data_path}/metrics/{self.worker_id}").start()
+        self.stopped = threading.Event()
+
+    def heartbeat(self) -> None:
+        while not self.stopped.wait(self.heartbeat_seconds):
+            if not self.coordinator.heartbeat(self.worker_id) and not self.stopped.is_set():
+                self.log.warning("Leases lost to the reaper; re-registering.")
+                self.worker_id = self.coordinator.register()["worker_id"]
+
+    def run(self, kinds: List[str] = KINDS) -> bool:
+        """Work until the coordinator's frontier is exhausted."""
+        threading.Thread(target=self.heartbeat, name="heartbeat", daemon=True).start()
+        try:
+            while not self.coordinator.done():
+                report = self.pipeline.run(
+                    claim=lambda count: self.coordinator.claim(self.worker_id, kinds, count),
+                    url=lambda job: job[1],
+                    parse_args=lambda job, html: (job[0][0], html, job[0][-1]),
+                    write=lambda job, html, scraped: self.coordinator.submit(
+                        self.worker_id, job[0], scraped,
+                        scraped is None and self.web.gone(job[1])))
+                if not report["write"]["pages"]:
+                    # Other workers still hold pages that may push more
+                    sleep(self.idle_seconds)
+        finally:
+            self.stopped.set()
+            self.coordinator.leave(self.worker_id)
+            self.log.info("HTTP stats: %s", self.web.stats())
+            self.web.close()
+            self.metrics.stop()
+        return True
@@ -1,32 +1,62 @@
 #!bin/python3
 
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
 import sqlite3
-from langdetect import detect, LangDetectException
+from time import time
 
 from app import SqliteInterface
 
-def make_language_table():
+# langdetect loads its language profiles on import, so only the worker
+# processes that tag reviews import it
+def _seed_detector():
+    from langdetect import DetectorFactory
+    DetectorFactory.seed = 0    # langdetect is randomized; make results repeatable
+
+def detect_language(body):
+    from langdetect import detect, LangDetectException
+    try:
+        return detect(body)
+    except LangDetectException:
+        return None
+
+def make_language_table(chunk_size=2000, processes=None):
     db = SqliteInterface.Interface(".")
     db.c.execute("CREATE TABLE IF NOT EXISTS language ("
                  "  lang TEXT NOT NULL,"
                  "  review INTEGER NOT NULL"
                  ");")
-    db.c.execute("SELECT * FROM user_reviews")
-    c_write = db.conn.cursor()
+    db.c.execute("DELETE FROM language WHERE rowid NOT IN "
+                 "  (SELECT MIN(rowid) FROM language GROUP BY review);")
+    db.c.execute("CREATE UNIQUE INDEX IF NOT EXISTS language_review ON language (review);")
+    db.conn.commit()
     failed = []
-    for _r in db.c:
-        review_id = _r[1]
-        body = _r[5]
-        try:
-            lang = detect(body)
-        except LangDetectException:
-            failed.append(str(review_id))
-            print("FAILURE")
-            continue
-        c_write.execute("INSERT INTO language (lang, review) VALUES (?, ?)",
-                                            (lang, review_id))
-        db.conn.commit()
-        print(f"Review {review_id} - {lang} detected")
+    tagged = 0
+    last_rowid = 0
+    with ProcessPoolExecutor(processes, initializer=_seed_detector) as pool:
+        while True:
+            db.c.execute("SELECT u.rowid, u.review_id, body_text(u.body) FROM user_reviews u"
+                         "  WHERE u.rowid > ? AND NOT EXISTS"
+                         "  (SELECT 1 FROM language l WHERE l.review=u.review_id)"
+                         "  ORDER BY u.rowid LIMIT ?", (last_rowid, chunk_size))
+            chunk = db.c.fetchall()
+            if not chunk:
+                break
+            last_rowid = chunk[-1][0]
+            langs = pool.map(detect_language, [_r[2] for _r in chunk],
+                             chunksize=max(1, chunk_size // 64))
+            rows = []
+            for _r, lang in zip(chunk, langs):
+                if lang is None:
+                    failed.append(str(_r[1]))
+                else:
+                    rows.append((lang, _r[1]))
+            db.c.executemany("INSERT INTO language (lang, review) VALUES (?, ?)"
+                             "  ON CONFLICT (review) DO NOTHING", rows)
+            db.conn.commit()
+            tagged += len(rows)
+            print(f"{tagged} reviews tagged, {len(failed)} failed")
     print(failed)
 
 def makedb_simple_binary():
@@ -41,7 +71,8 @@ def makedb_simple_binary():
         _schema = schema.format(_i)
         c_out.execute(_schema)
     db_out.commit()
-    db_in.c.execute("SELECT grade, review_id, body FROM user_reviews"\
+    # body_text() decodes compressed bodies; every Interface connection has it
+    db_in.c.execute("SELECT grade, review_id, body_text(body) FROM user_reviews"\
                  "  WHERE 'en' IN"\
                  "  (SELECT lang FROM language WHERE review=review_id);")
     for _r in db_in.c:
@@ -57,4 +88,92 @@ def makedb_simple_binary():
                        (_r[1], _r[2]))
 
         db_out.commit()
-        print(f"{_tbl.title()} review added to output.")
\ No newline at end of file
+        print(f"{_tbl.title()} review added to output.")
+
+# Columnar export - each table is streamed in rowid order, in bounded
+# chunks, to one Parquet file per platform per run; a rowid watermark
+# makes later runs append only rows added since. Bodies are read through
+# body_text(), so compressed ones are exported as text.
+PARQUET_EXPORTS = {
+    "games": (
+        "SELECT g.rowid, p.slug, g.rowid, g.title, g.slug, g.released, g.metascore"
+        "  FROM games g JOIN platforms p ON p.rowid=g.platform"
+        "  WHERE g.rowid > ? ORDER BY g.rowid",
+        ["game", "title", "slug", "released", "metascore"],
+    ),
+    "user_reviews": (
+        "SELECT u.rowid, p.slug, u.review_id, u.game, u.author, u.date, u.grade,"
+        "  u.votes_total, u.votes_helpful, body_text(u.body), {lang}"
+        "  FROM user_reviews u JOIN games g ON g.rowid=u.game"
+        "  JOIN platforms p ON p.rowid=g.platform {join}"
+        "  WHERE u.rowid > ? ORDER BY u.rowid",
+        ["review_id", "game", "author", "date", "grade",
+         "votes_total", "votes_helpful", "body", "lang"],
+    ),
+    "critic_reviews": (
+        "SELECT c.rowid, p.slug, c.game, c.author, c.date, c.grade, body_text(c.body)"
+        "  FROM critic_reviews c JOIN games g ON g.rowid=c.game"
+        "  JOIN platforms p ON p.rowid=g.platform"
+        "  WHERE c.rowid > ? ORDER BY c.rowid",
+        ["game", "author", "date", "grade", "body"],
+    ),
+}
+
+def _parquet_schema(pa, columns):
+    types = {"game": pa.int64(), "review_id": pa.int64(), "metascore": pa.int64(),
+             "grade": pa.int64(), "votes_total": pa.int64(), "votes_helpful": pa.int64()}
+    return pa.schema([(_c, types.get(_c, pa.string())) for _c in columns])
+
+def export_parquet(out_path="parquet", chunk_size=50000, compression="zstd"):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    db = SqliteInterface.Interface(".")
+    os.makedirs(out_path, exist_ok=True)
+    watermark_path = f"{out_path}/_watermark.json"
+    watermarks = {}
+    if os.path.isfile(watermark_path):
+        with open(watermark_path) as f:
+            watermarks = json.load(f)
+    db.c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='language'")
+    has_language = db.c.fetchone() is not None
+    run = int(time())
+    for table, (query, columns) in PARQUET_EXPORTS.items():
+        # Tables tagged before language_review existed may hold a review
+        # more than once; take one language each so no review is repeated
+        query = query.format(lang="l.lang" if has_language else "NULL",
+                             join="LEFT JOIN (SELECT review, MIN(lang) AS lang FROM language"
+                                  "  GROUP BY review) l ON l.review=u.review_id"
+                                  if has_language else "")
+        schema = _parquet_schema(pa, columns)
+        start = watermarks.get(table, 0)
+        writers = {}
+        exported = 0
+        db.c.execute(query, (start,))
+        while True:
+            chunk = db.c.fetchmany(chunk_size)
+            if not chunk:
+                break
+            watermarks[table] = chunk[-1][0]
+            by_platform = {}
+            for _r in chunk:
+                by_platform.setdefault(_r[1], []).append(_r[2:])
+            for platform, rows in by_platform.items():
+                if platform not in writers:
+                    part_dir = f"{out_path}/{table}/platform={platform}"
+                    os.makedirs(part_dir, exist_ok=True)
+                    part = f"{part_dir}/part-{run}-{start}.parquet"
+                    writers[platform] = (part, pq.ParquetWriter(f"{part}.tmp", schema,
+                                                                compression=compression))
+                arrays = [pa.array(_col, type=schema.field(_i).type)
+                          for _i, _col in enumerate(zip(*rows))]
+                writers[platform][1].write_table(pa.Table.from_arrays(arrays, schema=schema))
+            exported += len(chunk)
+        for part, writer in writers.values():
+            writer.close()
+            os.replace(f"{part}.tmp", part)
+        # Saved as soon as the table's parts are in place, so a run dying
+        # on a later table does not export this one's rows again
+        with open(f"{watermark_path}.tmp", "w") as f:
+            json.dump(watermarks, f)
+        os.replace(f"{watermark_path}.tmp", watermark_path)
+        print(f"{exported} rows exported from {table}.")
@@ -0,0 +1,102 @@
+import atexit
+from collections import defaultdict
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+import threading
+
+
+FORMAT = "%(asctime)s [%(name)-14s] %(levelname)-8s %(message)s"
+
+_queue = SimpleQueue()
+_listener = None
+_lock = threading.Lock()
+_level = logging.DEBUG
+_loggers = set()
+
+
+class LazyQueueHandler(QueueHandler):
+    """Enqueue records as they are, leaving all formatting to the listener.
+
+    The stock QueueHandler merges msg % args in the calling thread so the
+    record can be pickled; records here never leave the process.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """Pass one in every 1/rate records of each message template.
+
+    rate applies to DEBUG records; rates maps a message template (the
+    unformatted msg) to its own rate, at any level. INFO and above pass
+    unless listed in rates.
+    """
+
+    def __init__(self, rate: float = 1, rates: dict = None):
+        super().__init__()
+        self.rate = rate
+        self.rates = rates or {}
+        # Unlocked: a race only shifts which occurrence gets through.
+        self.seen = defaultdict(int)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.msg)
+        if rate is None:
+            rate = self.rate if record.levelno <= logging.DEBUG else 1
+        if rate >= 1:
+            return True
+        if rate <= 0:
+            return False
+        self.seen[record.msg] += 1
+        return (self.seen[record.msg] - 1) % round(1 / rate) == 0
+
+
+def start() -> None:
+    """Start the background thread writing queued records to stderr."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(FORMAT))
+        _listener = QueueListener(_queue, handler)
+        _listener.start()
+        atexit.register(stop)
+
+
+def stop() -> None:
+    """Drain the queue and stop the listener."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def configure(level=logging.DEBUG, sample: float = 1, rates: dict = None) -> None:
+    """Set the level and sampling of every logger from get_logger."""
+    global _level
+    _level = level
+    _sampler.rate = sample
+    _sampler.rates = rates or {}
+    for name in _loggers:
+        logging.getLogger(name).setLevel(level)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Return a logger feeding the shared queue, attaching its handler once."""
+    start()
+    logger = logging.getLogger(name)
+    if name not in _loggers:
+        handler = LazyQueueHandler(_queue)
+        handler.addFilter(_sampler)
+        logger.addHandler(handler)
+        logger.propagate = False
+        _loggers.add(name)
+    logger.setLevel(_level)
+    return logger
+
+
+_sampler = SampleFilter()
@@ -0,0 +1,157 @@
+import cProfile
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+import threading
+from time import perf_counter, time
+
+
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, float("inf"))
+
+
+class Histogram:
+    """Count, sum and cumulative-bucket distribution of observed seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def snapshot(self) -> dict:
+        cumulative, total = {}, 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            total += n
+            cumulative["+Inf" if bound == float("inf") else str(bound)] = total
+        return {"count": self.count, "sum": round(self.sum, 6), "max": round(self.max, 6),
+                "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+                "buckets": cumulative}
+
+
+class Registry:
+    """Thread-safe counters and timing histograms, keyed by name."""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time()
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+    def timed(self, name: str):
+        """Decorator timing every call of a function as name."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def instrument(self, prefix: str):
+        """Class decorator timing every public method as prefix_method."""
+        def decorator(cls):
+            for name, fn in list(vars(cls).items()):
+                if callable(fn) and not name.startswith("_"):
+                    setattr(cls, name, self.timed(f"{prefix}_{name}")(fn))
+            return cls
+        return decorator
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"time": round(time(), 3),
+                    "uptime_seconds": round(time() - self.started, 3),
+                    "counters": dict(self.counters),
+                    "timers": {_n: _h.snapshot() for _n, _h in self.histograms.items()}}
+
+    def prometheus(self, prefix: str = "mcscraper") -> str:
+        """Render the snapshot in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            lines += [f"# TYPE {prefix}_{name}_total counter",
+                      f"{prefix}_{name}_total {value}"]
+        for name, hist in sorted(snapshot["timers"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_seconds histogram")
+            for bound, n in hist["buckets"].items():
+                lines.append(f'{prefix}_{name}_seconds_bucket{{le="{bound}"}} {n}')
+            lines += [f"{prefix}_{name}_seconds_sum {hist['sum']}",
+                      f"{prefix}_{name}_seconds_count {hist['count']}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """Atomically write metrics.json and metrics.prom into path."""
+        os.makedirs(path, exist_ok=True)
+        for filename, content in [("metrics.json", json.dumps(self.snapshot(), indent=1)),
+                                  ("metrics.prom", self.prometheus())]:
+            with open(f"{path}/{filename}.tmp", "w") as f:
+                f.write(content)
+            os.replace(f"{path}/{filename}.tmp", f"{path}/{filename}")
+
+
+class Flusher:
+    """Background thread writing a registry snapshot every interval seconds."""
+
+    def __init__(self, registry: Registry, path: str, interval: float = 30):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics", daemon=True)
+
+    def start(self) -> "Flusher":
+        self.thread.start()
+        return self
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.registry.write(self.path)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.registry.write(self.path)
+
+
+def profile_call(path: str, fn, *args):
+    """Run fn under cProfile, dumping pstats to path; return its result."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args)
+    finally:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        profiler.dump_stats(path)
+
+
+REGISTRY = Registry()
+count = REGISTRY.count
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+timed = REGISTRY.timed
+instrument = REGISTRY.instrument
@@ -1,18 +1,62 @@
+from functools import lru_cache
+from importlib.util import find_spec
 import re
-from typing import List
+from time import perf_counter
+from typing import List, TYPE_CHECKING
 
-from bs4 import BeautifulSoup
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+# bs4 and the parser backend are imported on the first parse, not at startup
+PARSER = "lxml" if find_spec("lxml") else "html5lib"
 
 
 BASE_URL = "https://www.metacritic.com"
+# Subtrees read from each kind of page; with a parser that supports
+# parse_only (not html5lib) everything else is skipped while parsing.
+SCOPES = {
+    "genre_nav": ("ul", ["genre_nav"]),
+    "last_page": ("li", ["last_page"]),
+    "games": ("td", ["clamp-summary-wrap"]),
+    "user_reviews": ("li", ["user_review", "last_page"]),
+    "critic_reviews": ("li", ["critic_review", "last_page"]),
+}
+
+@lru_cache(maxsize=None)
+def _strainer(scope: str):
+    """SoupStrainer for scope; classes are matched by pattern because
+    strainers see the raw attribute."""
+    from bs4 import SoupStrainer
+    name, classes = SCOPES[scope]
+    return SoupStrainer(name, {"class": re.compile(rf"(^|\s)({'|'.join(classes)})(\s|$)")})
+
+def make_soup(html: str, scope: str = None, parser: str = None) -> "BeautifulSoup":
+    """Parse html with the fastest available backend, limited to scope."""
+    from bs4 import BeautifulSoup
+    parser = parser or PARSER
+    strainer = _strainer(scope) if scope and parser != "html5lib" else None
+    return BeautifulSoup(html, features=parser, parse_only=strainer)
+
+
+def check_parity(html: str, scope: str, parser: str = None) -> bool:
+    """True if a scoped parse gives the same scrape as a full html5lib parse."""
+    scraper = {
+        "genre_nav": get_title_by_genre_listing_page_urls,
+        "last_page": get_last_page_number,
+        "games": scrape_games,
+        "user_reviews": scrape_user_reviews,
+        "critic_reviews": scrape_critic_reviews,
+    }[scope]
+    reference = scraper(make_soup(html, parser="html5lib"))
+    return scraper(make_soup(html, scope, parser)) == reference
 
 # Methods for listing pages (pages using "flipper" divs for next/prev page)
-def get_title_by_genre_listing_page_urls(soup: BeautifulSoup) -> List[str]:
+def get_title_by_genre_listing_page_urls(soup: "BeautifulSoup", base_url: str = BASE_URL) -> List[str]:
     listings = soup.find("ul", {"class": "genre_nav"}).find_all("a")
-    return [f"{BASE_URL}{listing.attrs['href']}" for listing in listings]
+    return [f"{base_url}{listing.attrs['href']}" for listing in listings]
 
 
-def get_last_page_number(listing_page: BeautifulSoup) -> str(int):
+def get_last_page_number(listing_page: "BeautifulSoup") -> str(int):
     last_page_tag = listing_page.find("li", {"class": "last_page"})
     if not last_page_tag:
         return 0
@@ -20,7 +64,7 @@ def get_last_page_number(listing_page: BeautifulSoup) -> str(int):
 
 
 # Scraping methods
-def scrape_games(title_by_genre_listing_page: BeautifulSoup) -> List:
+def scrape_games(title_by_genre_listing_page: "BeautifulSoup") -> List:
     games = []
     soup = title_by_genre_listing_page
     for game_tag in soup.find_all("td", {"class": "clamp-summary-wrap"}):
@@ -35,7 +79,7 @@ def scrape_games(title_by_genre_listing_page: BeautifulSoup) -> List:
     return games
 
 
-def scrape_user_reviews(user_review_listing_page: BeautifulSoup) -> List:
+def scrape_user_reviews(user_review_listing_page: "BeautifulSoup") -> List:
     reviews = []
     soup = user_review_listing_page
     for rev_tag in soup.find_all("li", {"class": "user_review"}):
@@ -58,7 +102,7 @@ def scrape_user_reviews(user_review_listing_page: BeautifulSoup) -> List:
     return reviews
 
 
-def scrape_critic_reviews(critic_review_listing_page: BeautifulSoup) -> List:
+def scrape_critic_reviews(critic_review_listing_page: "BeautifulSoup") -> List:
     reviews = []
     soup = critic_review_listing_page
     for rev_tag in soup.find_all("li", {"class": "critic_review"}):
@@ -72,3 +116,107 @@ def scrape_critic_reviews(critic_review_listing_page: BeautifulSoup) -> List:
         review["date"] = None if not date or not date.text else date.text
         reviews.append(review)
     return reviews
+
+
+def scrape_page(kind: str, html: str, page_number: int = None) -> dict:
+    """Parse one crawled page into plain data, for use in a worker process.
+
+    kind is a frontier kind; "final_page_number" is only set where the
+    crawl records it (listing pages and the first review page); "timings"
+    splits the seconds spent building the soup from those spent scraping it.
+    """
+    scope = {"last_page": "last_page", "titles": "games",
+             "user": "user_reviews", "critic": "critic_reviews"}.get(kind)
+    if scope is None:
+        raise RuntimeError
+    start = perf_counter()
+    soup = make_soup(html, scope)
+    built = perf_counter()
+    if kind == "last_page":
+        final_page_number, items = int(get_last_page_number(soup)), []
+    elif kind == "titles":
+        final_page_number, items = None, scrape_games(soup)
+    else:
+        scraper = scrape_user_reviews if kind == "user" else scrape_critic_reviews
+        final_page_number = int(get_last_page_number(soup)) if page_number == 0 else None
+        items = scraper(soup)
+    return {"final_page_number": final_page_number, "items": items,
+            "timings": {"soup": built - start, "scrape": perf_counter() - built}}
+
+
+# Streaming - items scraped while the page is still downloading
+ITEMS = {"titles": ("td", "clamp-summary-wrap", scrape_games),
+         "user": ("li", "user_review", scrape_user_reviews),
+         "critic": ("li", "critic_review", scrape_critic_reviews)}
+
+
+class PageStream:
+    """One crawled page scraped from its chunks as they arrive.
+
+    Iterating yields the page's items as soon as each element has been
+    parsed, then sets final_page_number (as scrape_page does) and count.
+    Each element is handed to the same scrapers as a buffered parse, so
+    both give the same rows, and is dropped from the tree once scraped.
+    """
+
+    def __init__(self, kind: str, chunks, page_number: int = None):
+        if kind not in ["last_page", "titles", "user", "critic"]:
+            raise RuntimeError
+        self.kind = kind
+        self.chunks = chunks
+        self.page_number = page_number
+        self.final_page_number = None
+        self.count = 0
+        self.done = False
+
+    def __iter__(self):
+        if PARSER != "lxml":
+            scraped = scrape_page(self.kind, "".join(self.chunks), self.page_number)
+            self.count = len(scraped["items"])
+            yield from scraped["items"]
+            self.final_page_number = scraped["final_page_number"]
+            self.done = True
+            return
+        from lxml import etree
+        tag, item_class, scraper = ITEMS.get(self.kind, ("li", None, None))
+        parser = etree.HTMLPullParser(events=("end",), tag=list({tag, "li"}))
+        last_page = 0
+
+        def scrape(events):
+            nonlocal last_page
+            for _, element in events:
+                classes = element.get("class", "").split()
+                if "last_page" in classes:
+                    last_page = get_last_page_number(make_soup(_fragment(element)))
+                elif item_class in classes:
+                    yield from scraper(make_soup(_fragment(element)))
+                else:
+                    continue
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+        for chunk in self.chunks:
+            parser.feed(chunk)
+            for item in scrape(parser.read_events()):
+                self.count += 1
+                yield item
+        parser.close()
+        for item in scrape(parser.read_events()):
+            self.count += 1
+            yield item
+        if self.kind == "last_page" or (self.kind != "titles" and self.page_number == 0):
+            self.final_page_number = int(last_page)
+        self.done = True
+
+    def final(self) -> int:
+        """final_page_number, reading the rest of the page first if need be."""
+        if not self.done:
+            for _ in self:
+                pass
+        return self.final_page_number
+
+
+def _fragment(element) -> str:
+    from lxml import etree
+    return etree.tostring(element, encoding="unicode", method="html", with_tail=False)
@@ -0,0 +1,208 @@
+from concurrent.futures import ProcessPoolExecutor
+from queue import Queue
+from random import random
+import threading
+from time import monotonic, process_time
+from typing import Callable, List
+
+from app import metrics
+
+
+class StageStats:
+    """Pages handled and seconds spent busy by one pipeline stage.
+
+    Utilization is busy time over the time its workers were available;
+    the stage closest to 1.0 is the bottleneck.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pages = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self.lock:
+            self.pages += 1
+            self.busy += seconds
+
+    def report(self, wall: float) -> dict:
+        with self.lock:
+            return {"pages": self.pages,
+                    "busy_seconds": round(self.busy, 3),
+                    "pages_per_second": round(self.pages / wall, 3) if wall else 0.0,
+                    "utilization": round(self.busy / (wall * self.workers), 3) if wall else 0.0}
+
+
+def timed(fn: Callable, *args, profile_path: str = None):
+    """Run fn in a parse worker, returning (result, CPU seconds); under
+    cProfile, dumped to profile_path, if one is given."""
+    start = process_time()
+    result = metrics.profile_call(profile_path, fn, *args) if profile_path else fn(*args)
+    return result, process_time() - start
+
+
+class Pipeline:
+    """Fetch -> parse -> write stages connected by bounded queues.
+
+    Fetching runs on fetch_workers threads and parsing on a pool of
+    parse_workers processes; the thread calling run() is the only writer,
+    so it keeps sole ownership of the SQLite connection. At most `capacity`
+    pages are between claim and write, which bounds every queue and
+    makes a slow stage back-pressure the ones before it.
+
+    With profile_rate > 0 that fraction of parses and writes runs under
+    cProfile, each dumping a .pstats file into profile_path.
+
+    With a stream callable there is no parse stage: fetch returns a page's
+    chunks as they are downloaded, stream(*parse_args(item, chunks)) wraps
+    them in an iterable of items, and the writer consumes it, so rows reach
+    the database while the rest of the page is still arriving.
+    """
+
+    def __init__(self, logger, fetch: Callable, parse: Callable,
+                 fetch_workers: int = 4, parse_workers: int = 2,
+                 capacity: int = 16, report_seconds: float = 60,
+                 profile_rate: float = 0, profile_path: str = "profiles",
+                 stream: Callable = None):
+        self.log = logger
+        self.fetch = fetch
+        self.parse = parse
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers
+        self.capacity = capacity
+        self.report_seconds = report_seconds
+        self.profile_rate = profile_rate
+        self.profile_path = profile_path
+        self.stream = stream
+        self.profiled = 0
+        self.stats = {}
+        self.wall = 0.0
+
+    def run(self, claim: Callable[[int], List], url: Callable, parse_args: Callable,
+            write: Callable) -> dict:
+        """Process claimed work until claim() returns nothing and the
+        pipeline drains; return the per-stage report.
+
+        claim(n) returns up to n work items, url(item) the page to fetch,
+        parse_args(item, html) the arguments for parse, and write(item,
+        html, parsed) stores the result. parse is skipped when html is None.
+        """
+        self.stats = {"fetch": StageStats(self.fetch_workers),
+                      "parse": StageStats(self.parse_workers),
+                      "write": StageStats(1)}
+        fetch_q = Queue(self.capacity + self.fetch_workers)
+        parse_q = Queue(self.capacity)
+        write_q = Queue(self.capacity)
+        if self.stream:
+            processes = None
+            threads = [threading.Thread(target=self.stream_stage,
+                                        args=(fetch_q, write_q, url, parse_args),
+                                        name=f"fetch-{_i}", daemon=True)
+                       for _i in range(self.fetch_workers)]
+        else:
+            processes = ProcessPoolExecutor(max_workers=self.parse_workers)
+            threads = [threading.Thread(target=self.fetch_stage, args=(fetch_q, parse_q, url),
+                                        name=f"fetch-{_i}", daemon=True)
+                       for _i in range(self.fetch_workers)]
+            threads += [threading.Thread(target=self.parse_stage,
+                                         args=(parse_q, write_q, processes, parse_args),
+                                         name=f"parse-{_i}", daemon=True)
+                        for _i in range(self.parse_workers)]
+        for thread in threads:
+            thread.start()
+        started = last_report = monotonic()
+        in_flight = 0
+        try:
+            while True:
+                room = self.capacity - in_flight
+                if room and (in_flight == 0 or room >= self.capacity // 2):
+                    for item in claim(room):
+                        fetch_q.put(item)
+                        in_flight += 1
+                if in_flight == 0:
+                    break
+                item, html, parsed = write_q.get()
+                in_flight -= 1
+                if isinstance(parsed, Exception):
+                    raise parsed
+                start = monotonic()
+                profile_path = self.sample("write")
+                if profile_path:
+                    metrics.profile_call(profile_path, write, item, html, parsed)
+                else:
+                    write(item, html, parsed)
+                self.stats["write"].add(monotonic() - start)
+                metrics.observe("write", monotonic() - start)
+                if monotonic() - last_report > self.report_seconds:
+                    last_report = monotonic()
+                    self.log.info("Pipeline: %s", self.report(last_report - started))
+        finally:
+            for _ in range(self.fetch_workers):
+                fetch_q.put(None)
+            if processes:
+                processes.shutdown(wait=False, cancel_futures=True)
+        self.wall = monotonic() - started
+        report = self.report(self.wall)
+        self.log.info("Pipeline: %s", report)
+        return report
+
+    def fetch_stage(self, fetch_q: Queue, parse_q: Queue, url: Callable) -> None:
+        while True:
+            item = fetch_q.get()
+            if item is None:
+                parse_q.put(None)
+                return
+            start = monotonic()
+            try:
+                html = self.fetch(url(item))
+            except Exception as e:
+                html = e
+            self.stats["fetch"].add(monotonic() - start)
+            parse_q.put((item, html))
+
+    def stream_stage(self, fetch_q: Queue, write_q: Queue, url: Callable,
+                     parse_args: Callable) -> None:
+        while True:
+            item = fetch_q.get()
+            if item is None:
+                return
+            start = monotonic()
+            try:
+                chunks = self.fetch(url(item))
+            except Exception as e:
+                chunks = e
+            self.stats["fetch"].add(monotonic() - start)
+            if isinstance(chunks, Exception) or chunks is None:
+                write_q.put((item, None, chunks))
+            else:
+                write_q.put((item, None, self.stream(*parse_args(item, chunks))))
+
+    def parse_stage(self, parse_q: Queue, write_q: Queue, processes: ProcessPoolExecutor,
+                    parse_args: Callable) -> None:
+        while True:
+            job = parse_q.get()
+            if job is None:
+                return
+            item, html = job
+            if isinstance(html, Exception) or html is None:
+                write_q.put((item, None, html))
+                continue
+            try:
+                parsed, seconds = processes.submit(timed, self.parse, *parse_args(item, html),
+                                                   profile_path=self.sample("parse")).result()
+                self.stats["parse"].add(seconds)
+                metrics.observe("parse_cpu", seconds)
+            except Exception as e:
+                parsed = e
+            write_q.put((item, html, parsed))
+
+    def sample(self, stage: str) -> str:
+        """Return a .pstats path for a sampled page, or None."""
+        if not self.profile_rate or random() >= self.profile_rate:
+            return None
+        self.profiled += 1
+        return f"{self.profile_path}/{stage}-{self.profiled}-{threading.get_ident()}.pstats"
+
+    def report(self, wall: float) -> dict:
+        return {name: stage.report(wall) for name, stage in self.stats.items()}
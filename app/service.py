@@ -0,0 +1,218 @@
+import argparse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from queue import Empty, Queue
+import re
+import sqlite3
+import threading
+from urllib.parse import parse_qs, quote, urlsplit
+
+from app import compress
+from app import logs
+from app import metrics
+from app import SqliteInterface
+
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+# Keyset pages - each query takes (..., after, limit) and returns rows in
+# key order; a page's last key is the next page's `after`
+QUERIES = {
+    "games": (
+        "SELECT g.rowid, g.title, g.slug, p.slug, g.released, g.metascore"
+        "  FROM games g JOIN platforms p ON p.rowid=g.platform"
+        "  WHERE g.rowid > ? ORDER BY g.rowid LIMIT ?",
+        ["game", "title", "slug", "platform", "released", "metascore"],
+    ),
+    "platform_games": (
+        "SELECT g.rowid, g.title, g.slug, p.slug, g.released, g.metascore"
+        "  FROM games g JOIN platforms p ON p.rowid=g.platform"
+        "  WHERE p.slug=? AND g.rowid > ? ORDER BY g.rowid LIMIT ?",
+        ["game", "title", "slug", "platform", "released", "metascore"],
+    ),
+    "user": (
+        "SELECT rowid, review_id, game, author, date, grade, body_text(body),"
+        "  votes_total, votes_helpful FROM user_reviews"
+        "  WHERE {where} AND rowid > ? ORDER BY rowid LIMIT ?",
+        ["id", "review_id", "game", "author", "date", "grade", "body",
+         "votes_total", "votes_helpful"],
+    ),
+    "critic": (
+        "SELECT rowid, game, author, date, grade, body_text(body) FROM critic_reviews"
+        "  WHERE {where} AND rowid > ? ORDER BY rowid LIMIT ?",
+        ["id", "game", "author", "date", "grade", "body"],
+    ),
+    "aggregates": (
+        f"SELECT game, {', '.join(SqliteInterface.AGGREGATE_COLUMNS)} FROM review_aggregates"
+        "  WHERE review_type=? AND reviews > 0 AND game > ? ORDER BY game LIMIT ?",
+        None,
+    ),
+}
+REVIEWS_WHERE = {
+    "game": "game=?",
+    # The unary + keeps the game index out, so the scan walks rowids from
+    # `after` instead of gathering and sorting every game's reviews
+    "platform": "+game IN (SELECT g.rowid FROM games g JOIN platforms p"
+                "  ON p.rowid=g.platform WHERE p.slug=?)",
+}
+ROUTES = [
+    (re.compile(r"^/games$"), "games"),
+    (re.compile(r"^/platforms/([^/]+)/games$"), "platform_games"),
+    (re.compile(r"^/games/(\d+)/reviews$"), "game_reviews"),
+    (re.compile(r"^/platforms/([^/]+)/reviews$"), "platform_reviews"),
+    (re.compile(r"^/aggregates$"), "aggregates"),
+]
+
+
+class Pooled:
+    """A read-only connection and the body codec for its thread of use."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA query_only=1")
+        self.codec = compress.BodyCodec().load(self.conn.cursor())
+        self.conn.create_function("body_text", 1, self.codec.decode, deterministic=True)
+        self.generation = 0
+
+
+class QueryService:
+    """Read-only JSON queries over a live crawl database.
+
+    Queries run on a pool of read-only connections, which in WAL mode
+    neither block nor are blocked by the crawler's writes. Every list is
+    keyset-paginated, so a deep page costs the same as the first.
+    Responses are cached until the database changes: a separate watch
+    connection reads PRAGMA data_version, which moves whenever another
+    connection commits, and each move starts a new cache generation.
+    """
+
+    def __init__(self, data_path: str = ".", pool_size: int = 4, cache_size: int = 1024,
+                 pool_timeout: float = 10):
+        path = f"{data_path}/MCScraper.sqlite3.db"
+        self.log = logs.get_logger("QueryService")
+        self.pool = Queue()
+        for _ in range(pool_size):
+            self.pool.put(Pooled(path))
+        self.pool_timeout = pool_timeout
+        self.watch = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True,
+                                     check_same_thread=False)
+        self.watch_lock = threading.Lock()
+        self.data_version = None
+        self.generation = 0
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+
+    def current_generation(self) -> int:
+        """The cache generation, starting a new one if the database has
+        changed since the last request."""
+        with self.watch_lock:
+            data_version = self.watch.execute("PRAGMA data_version").fetchone()[0]
+            if data_version != self.data_version:
+                self.data_version = data_version
+                self.generation += 1
+            return self.generation
+
+    def get(self, path: str) -> tuple:
+        """Answer a GET path with (status, JSON-able body)."""
+        generation = self.current_generation()
+        with self.cache_lock:
+            cached = self.cache.get(path)
+            if cached and cached[0] == generation:
+                self.cache.move_to_end(path)
+                metrics.count("service_cache_hits")
+                return 200, cached[1]
+        metrics.count("service_cache_misses")
+        try:
+            with metrics.timer("service_query"):
+                body = self.query(path, generation)
+        except ValueError as e:
+            return 400, {"error": f"{type(e).__name__}: {e}"}
+        except LookupError:
+            return 404, {"error": "not found"}
+        except Empty:
+            return 503, {"error": "no connection available"}
+        with self.cache_lock:
+            self.cache[path] = (generation, body)
+            self.cache.move_to_end(path)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return 200, body
+
+    def query(self, path: str, generation: int) -> dict:
+        url = urlsplit(path)
+        params = {_k: _v[-1] for _k, _v in parse_qs(url.query).items()}
+        limit = max(1, min(int(params.get("limit", DEFAULT_LIMIT)), MAX_LIMIT))
+        after = int(params.get("after", 0))
+        for pattern, route in ROUTES:
+            match = pattern.match(url.path)
+            if match:
+                break
+        else:
+            raise LookupError
+        if route in ["games", "platform_games"]:
+            sql, columns = QUERIES[route]
+            args = list(match.groups())
+        else:
+            review_type = params.get("type", "user")
+            if review_type not in ["user", "critic"]:
+                raise ValueError(review_type)
+            if route == "aggregates":
+                sql, columns = QUERIES[route]
+                args = [review_type]
+            else:
+                sql, columns = QUERIES[review_type]
+                sql = sql.format(where=REVIEWS_WHERE[route.split("_")[0]])
+                key = match.group(1)
+                args = [int(key) if route == "game_reviews" else key]
+        pooled = self.pool.get(timeout=self.pool_timeout)
+        try:
+            if pooled.generation != generation:
+                # compress_bodies may have trained a dictionary since
+                dictionaries = pooled.conn.execute(
+                    "SELECT COUNT(*) FROM body_dictionaries").fetchone()[0]
+                if dictionaries != len(pooled.codec.dictionaries):
+                    pooled.codec.load(pooled.conn.cursor())
+                pooled.generation = generation
+            rows = pooled.conn.execute(sql, args + [after, limit + 1]).fetchall()
+        finally:
+            self.pool.put(pooled)
+        items = [SqliteInterface.aggregate_row(_r) if columns is None
+                 else dict(zip(columns, _r)) for _r in rows[:limit]]
+        return {"items": items, "next": rows[limit - 1][0] if len(rows) > limit else None}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status, body = self.server.service.get(self.path)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        self.server.service.log.debug(format, *args)
+
+
+def serve(address: tuple, service: QueryService) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve read-only queries over a crawl database.")
+    parser.add_argument("--data-path", default=".")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8321)
+    parser.add_argument("--pool", type=int, default=4, help="read-only connections")
+    args = parser.parse_args()
+    server = serve((args.host, args.port), QueryService(args.data_path, pool_size=args.pool))
+    server.service.log.info("Serving queries on %s:%s.", *server.server_address)
+    server.serve_forever()
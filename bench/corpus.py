@@ -0,0 +1,98 @@
+"""Synthetic Metacritic pages shaped like the markup parse.py reads.
+
+Every page is wrapped in enough navigation, script and footer markup to
+resemble the size of a real page, since most of parse time goes to
+markup the scrapers never look at.
+"""
+from hashlib import md5
+from random import Random
+
+
+WORDS = ("game story combat graphics sound music level boss puzzle world "
+         "open mission character controls camera frame rate multiplayer "
+         "campaign hours fun boring amazing broken patch sequel").split()
+
+CHROME = "".join(
+    f"<div class='nav_item'><a href='/browse/{_i}'>Link {_i}</a>"
+    f"<script>var ad_{_i} = {{slot: '{_i}', sizes: [[300, 250]]}};</script></div>"
+    for _i in range(400))
+
+
+def _text(rng: Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _page(body: str, last_page: int = None) -> str:
+    pager = "" if last_page is None else (
+        "<div class='page_nav'><ul class='pages'>"
+        f"<li class='page last_page'><span class='page_num'>"
+        f"<a href='?page={last_page}'>{last_page + 1}</a></span></li></ul></div>")
+    return (f"<!DOCTYPE html><html><head><title>Metacritic</title></head><body>"
+            f"<div id='site_layout'><div class='header'>{CHROME}</div>"
+            f"<div id='main'>{body}{pager}</div><div class='footer'>{CHROME}</div>"
+            f"</div></body></html>")
+
+
+def platform_home_page(platform: str, genres: list) -> str:
+    items = "".join(f"<li><a href='/browse/games/genre/date/{_g}/{platform}'>{_g}</a></li>"
+                    for _g in genres)
+    return _page(f"<ul class='genre_nav'>{items}</ul>")
+
+
+def listing_page(platform: str, genre: str, page: int, games: int, last_page: int) -> str:
+    rng = Random(f"{platform}/{genre}/{page}")
+    rows = []
+    for _i in range(games):
+        slug = game_slug(genre, page, _i)
+        rows.append(
+            "<tr><td class='clamp-image-wrap'><img src='x.jpg'/></td>"
+            "<td class='clamp-summary-wrap'><div class='clamp-score-wrap'>"
+            f"<a class='metascore_anchor'><div class='metascore_w large game positive'>"
+            f"{rng.randint(40, 99)}</div></a></div>"
+            f"<a href='/game/{platform}/{slug}' class='title'><h3>{slug.replace('-', ' ').title()}</h3></a>"
+            "<div class='clamp-details'><div class='platform'><span class='label'>Platform:</span>"
+            f"<span class='data'>{platform}</span></div>"
+            f"<span>March {rng.randint(1, 28)}, {rng.randint(2005, 2021)}</span></div>"
+            f"<div class='summary'>{_text(rng, 40)}</div></td></tr>")
+    return _page(f"<table class='clamp-list'>{''.join(rows)}</table>", last_page)
+
+
+def user_review_page(game: str, page: int, reviews: int, last_page: int) -> str:
+    rng = Random(f"user/{game}/{page}")
+    items = []
+    for _i in range(reviews):
+        review_id = int(md5(f"{game}/{page}/{_i}".encode()).hexdigest()[:8], 16)
+        body = _text(rng, rng.randint(20, 300))
+        collapsed = body[:100]
+        items.append(
+            f"<li id='user_review_{review_id}' class='review user_review'>"
+            "<div class='review_content'><div class='review_section'><div class='review_stats'>"
+            f"<div class='review_critic'><div class='name'> <a href='/user/u{_i}'>user{rng.randint(1, 10 ** 6)}</a> </div>"
+            f"<div class='date'>Mar {rng.randint(1, 28)}, 2020</div></div>"
+            f"<div class='review_grade'><div class='metascore_w user large game positive indiv'>{rng.randint(0, 10)}</div></div></div>"
+            "<div class='review_body'>"
+            + (f"<span class='blurb blurb_collapsed'>{collapsed}</span>"
+               f"<span class='blurb blurb_expanded'>{body}</span>" if len(body) > 100
+               else f"<span>{body}</span>")
+            + "</div></div><div class='review_section review_actions'><div class='review_helpful'>"
+            f"<span class='total_ups'>{rng.randint(0, 5)}</span> of "
+            f"<span class='total_thumbs'>{rng.randint(5, 10)}</span></div></div></div></li>")
+    return _page(f"<ol class='reviews user_reviews'>{''.join(items)}</ol>", last_page)
+
+
+def critic_review_page(game: str, page: int, reviews: int, last_page: int) -> str:
+    rng = Random(f"critic/{game}/{page}")
+    items = []
+    for _i in range(reviews):
+        items.append(
+            "<li class='review critic_review'><div class='review_content'><div class='review_section'>"
+            f"<div class='review_stats'><div class='review_critic'><div class='source'>"
+            f"<a href='/publication/p'>{game} Publication {page}-{_i}</a></div>"
+            f"<div class='date'>Mar {rng.randint(1, 28)}, 2020</div></div>"
+            f"<div class='review_grade'><div class='metascore_w medium game positive indiv'>{rng.randint(30, 100)}</div></div></div>"
+            f"<div class='review_body'>\n  {_text(rng, rng.randint(20, 60))}\n</div></div></div></li>")
+    return _page(f"<ol class='reviews critic_reviews'>{''.join(items)}</ol>", last_page)
+
+
+def game_slug(genre: str, page: int, index: int) -> str:
+    return f"{genre}-game-{page}-{index}"
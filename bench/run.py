@@ -0,0 +1,158 @@
+"""Offline benchmarks for the scraper.
+
+    python -m bench.run [--quick] [--output results.json]
+
+Runs parse and database microbenchmarks and an end-to-end crawl of the
+local stand-in with throttling disabled, then prints the results as
+JSON so they can be compared between releases.
+"""
+import argparse
+import json
+import logging
+import platform
+import resource
+import sqlite3
+import sys
+import tempfile
+from time import perf_counter, time
+import tracemalloc
+
+from app import parse
+from app import SqliteInterface
+from bench import corpus
+from bench.server import Site, serve
+
+
+def timeit(fn, repeat: int) -> float:
+    """Return the best-of-repeat seconds for one call of fn."""
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_parse(repeat: int) -> dict:
+    pages = {
+        "scrape_games": ("games", parse.scrape_games,
+                         corpus.listing_page("pc", "action", 0, 100, 5)),
+        "scrape_user_reviews": ("user_reviews", parse.scrape_user_reviews,
+                                corpus.user_review_page("game", 0, 100, 5)),
+        "scrape_critic_reviews": ("critic_reviews", parse.scrape_critic_reviews,
+                                  corpus.critic_review_page("game", 0, 100, 5)),
+    }
+    results = {}
+    for name, (scope, scraper, html) in pages.items():
+        result = {"page_bytes": len(html), "parity": parse.check_parity(html, scope)}
+        for label, parser, page_scope in [("html5lib", "html5lib", None),
+                                          (parse.PARSER, parse.PARSER, scope)]:
+            seconds = timeit(lambda: scraper(parse.make_soup(html, page_scope, parser)), repeat)
+            result[f"{label}_ms"] = round(seconds * 1000, 3)
+        tracemalloc.start()
+        scraper(parse.make_soup(html, scope))
+        result["peak_kb"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+        results[name] = result
+    return results
+
+
+def bench_db(rows: int) -> dict:
+    games = [{"title": f"Game {_i}", "slug": f"game-{_i}", "released": "March 1, 2020",
+              "metascore": 80} for _i in range(rows)]
+    users = [{"review_id": _i, "author": f"user{_i}", "date": "Mar 1, 2020", "grade": _i % 11,
+              "body": corpus._text(corpus.Random(_i), 80), "votes_total": 3, "votes_helpful": 1}
+             for _i in range(rows)]
+    critics = [{"author": f"Publication {_i}", "date": "Mar 1, 2020", "grade": 80,
+                "body": corpus._text(corpus.Random(_i), 40)} for _i in range(rows)]
+    results = {}
+    with tempfile.TemporaryDirectory() as data_path:
+        db = SqliteInterface.Interface(data_path)
+        db.new_platform_genre_crawl_url(1, 1, "listing")
+        start = perf_counter()
+        for _g in games:
+            db.new_game(platform=1, **_g)
+        results["new_game"] = rows / (perf_counter() - start)
+        start = perf_counter()
+        for _r in users:
+            db.new_user_review(game_pk=1, **_r)
+        results["new_user_review"] = rows / (perf_counter() - start)
+        start = perf_counter()
+        for _r in critics:
+            db.new_critic_review(game_pk=1, **_r)
+        results["new_critic_review"] = rows / (perf_counter() - start)
+        start = perf_counter()
+        for _i in range(rows):
+            db.new_platform_genre_crawl_url(1, 1, f"listing-{_i}")
+        results["new_platform_genre_crawl_url"] = rows / (perf_counter() - start)
+        # page-level batch writes of the same volume, 20 rows per page
+        db = SqliteInterface.Interface(tempfile.mkdtemp(dir=data_path))
+        db.new_platform_genre_crawl_url(1, 1, "listing")
+        start = perf_counter()
+        for _p in range(0, rows, 20):
+            db.write_games_page("listing", _p, games[_p:_p + 20], 1, 1)
+        results["write_games_page"] = rows / (perf_counter() - start)
+        start = perf_counter()
+        for _p in range(0, rows, 20):
+            db.write_user_review_page(1, _p, users[_p:_p + 20])
+        results["write_user_review_page"] = rows / (perf_counter() - start)
+        start = perf_counter()
+        for _p in range(0, rows, 20):
+            db.write_critic_review_page(1, _p, critics[_p:_p + 20])
+        results["write_critic_review_page"] = rows / (perf_counter() - start)
+    return {name: {"rows_per_second": round(rate, 1)} for name, rate in results.items()}
+
+
+def bench_end_to_end(site: Site, workers: int, parse_workers: int) -> dict:
+    from app.App import App
+    server, base_url = serve(site)
+    with tempfile.TemporaryDirectory() as data_path:
+        app = App(data_path=data_path, workers=workers, parse_workers=parse_workers,
+                  base_url=base_url, throttle_seconds=0)
+        for name in ["MCGameScraper", "WebInterface", "Pipeline"]:
+            logging.getLogger(name).setLevel(logging.WARNING)
+        start = perf_counter()
+        app.main()
+        seconds = perf_counter() - start
+        conn = sqlite3.connect(f"{data_path}/MCScraper.sqlite3.db")
+        rows = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ["games", "user_reviews", "critic_reviews"]}
+        pages = app.web.stats()["requests"]
+    server.shutdown()
+    # the crawler also requests the home page of every platform the site lacks
+    expected = site.total_pages() + len(SqliteInterface.PLATFORMS) - len(site.platforms)
+    return {"pages": pages, "expected_pages": expected, "seconds": round(seconds, 3),
+            "pages_per_second": round(pages / seconds, 2), "rows": rows,
+            "review_phase_stages": app.pipeline.report(app.pipeline.wall)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="smaller corpus and fewer repeats")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--parse-workers", type=int, default=2)
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    args = parser.parse_args()
+    site = Site(genres=("action",), listing_pages=1, games_per_page=3, review_pages=2) \
+        if args.quick else Site()
+    results = {
+        "meta": {"time": int(time()), "python": platform.python_version(),
+                 "sqlite": sqlite3.sqlite_version, "parser": parse.PARSER,
+                 "quick": args.quick},
+        "parse": bench_parse(repeat=3 if args.quick else 10),
+        "db": bench_db(rows=500 if args.quick else 5000),
+        "end_to_end": bench_end_to_end(site, args.workers, args.parse_workers),
+    }
+    results["meta"]["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Local HTTP stand-in for metacritic.com serving the synthetic corpus."""
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import re
+import threading
+
+from bench import corpus
+
+
+class Site:
+    """Shape of the synthetic site: every platform lists the same genres,
+    and every game has the same number of review pages."""
+
+    def __init__(self, platforms=("pc",), genres=("action", "racing"), listing_pages=2,
+                 games_per_page=5, review_pages=3, reviews_per_page=20):
+        self.platforms = platforms
+        self.genres = genres
+        self.listing_pages = listing_pages
+        self.games_per_page = games_per_page
+        self.review_pages = review_pages
+        self.reviews_per_page = reviews_per_page
+
+    def page(self, path: str):
+        match = re.match(r"^/game/([\w-]+)$", path)
+        if match and match.group(1) in self.platforms:
+            return corpus.platform_home_page(match.group(1), self.genres)
+        match = re.match(r"^/browse/games/genre/date/([\w-]+)/([\w-]+)(?:\?page=(\d+))?$", path)
+        if match and match.group(2) in self.platforms:
+            genre, platform, page = match.groups()
+            if page is None:
+                return corpus.listing_page(platform, genre, 0, 0, self.listing_pages - 1)
+            return corpus.listing_page(platform, genre, int(page), self.games_per_page,
+                                       self.listing_pages - 1)
+        match = re.match(r"^/game/([\w-]+)/([\w-]+)/(user|critic)-reviews\?page=(\d+)$", path)
+        if match and match.group(1) in self.platforms:
+            platform, game, kind, page = match.groups()
+            if int(page) >= self.review_pages:
+                return None
+            page_fn = corpus.user_review_page if kind == "user" else corpus.critic_review_page
+            return page_fn(game, int(page), self.reviews_per_page, self.review_pages - 1)
+        return None
+
+    def total_pages(self) -> int:
+        listings = len(self.platforms) * len(self.genres)
+        games = listings * self.listing_pages * self.games_per_page
+        return len(self.platforms) + listings * (1 + self.listing_pages) \
+            + games * 2 * self.review_pages
+
+
+def serve(site: Site):
+    """Start the stand-in on a free port; return (server, base_url)."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            html = site.page(self.path)
+            body = (html or "Not found").encode()
+            etag = f'"{md5(body).hexdigest()}"'
+            if html and self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200 if html else 404)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
@@ -0,0 +1,43 @@
+"""Scoped and streamed parses must scrape the same rows as a full html5lib
+parse, on the synthetic pages of bench.corpus."""
+import pytest
+
+pytest.importorskip("bs4")
+pytest.importorskip("html5lib")
+
+from app import parse
+from bench import corpus
+
+
+PAGES = {
+    "genre_nav": corpus.platform_home_page("pc", ["action", "racing", "sport"]),
+    "last_page": corpus.listing_page("pc", "action", 0, 25, 3),
+    "games": corpus.listing_page("pc", "action", 1, 25, 3),
+    "user_reviews": corpus.user_review_page("action-game-0-0", 0, 40, 5),
+    "critic_reviews": corpus.critic_review_page("action-game-0-0", 0, 30, 4),
+}
+PARSERS = ["html5lib"] + (["lxml"] if parse.PARSER == "lxml" else [])
+STREAMS = [
+    ("last_page", PAGES["last_page"], None),
+    ("titles", PAGES["games"], None),
+    ("user", PAGES["user_reviews"], 0),
+    ("user", corpus.user_review_page("action-game-0-0", 2, 40, 5), 2),
+    ("critic", PAGES["critic_reviews"], 0),
+]
+
+
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("scope", sorted(PAGES))
+def test_scoped_parse(scope, parser):
+    assert parse.check_parity(PAGES[scope], scope, parser)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 16384])
+@pytest.mark.parametrize("kind,html,page_number", STREAMS)
+def test_page_stream(kind, html, page_number, chunk_size):
+    expected = parse.scrape_page(kind, html, page_number)
+    stream = parse.PageStream(kind, (html[_i:_i + chunk_size]
+                                     for _i in range(0, len(html), chunk_size)), page_number)
+    assert list(stream) == expected["items"]
+    assert stream.final_page_number == expected["final_page_number"]
+    assert stream.count == len(expected["items"])